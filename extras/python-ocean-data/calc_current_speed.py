@@ -1,64 +1,257 @@
 import os, sys
+import argparse
 import datetime
+import glob
+import multiprocessing
+import time
 from git import Repo
 
+import numpy as np
 from netCDF4 import Dataset
 
 
 def main():
     # Read command line arguments
-    script = sys.argv[0]
-    inFile = sys.argv[1]
-    uVar = sys.argv[2]
-    vVar = sys.argv[3]
-    outfile_name = sys.argv[4]
-
-    # Read input data 
-    uData, vData, input_DATA = read_data(inFile, uVar, vVar)
-    
-    # Calculate the current speed
-    spData = calc_speed(uData, vData)
+    parser = argparse.ArgumentParser(description='Calculate the current speed, and other derived variables, from the U and V components')
+    parser.add_argument('inFile', help='input netCDF file. With --batch, a glob pattern or @FILE listing one input per line')
+    parser.add_argument('uVar', help='name of the eastward current variable')
+    parser.add_argument('vVar', help='name of the northward current variable')
+    parser.add_argument('outfile_name', help='output netCDF file. With --batch, the directory to write outputs to')
+    parser.add_argument('--derive', type=parse_derived, default=['SPCUR'],
+                        help='comma separated derived variables to calculate, all in one pass over the input. '
+                             'Choose from %s. Defaults to SPCUR' %(', '.join(sorted(DERIVED))))
+    parser.add_argument('--chunk', type=int, default=None,
+                        help='process this many time steps at a time, instead of the whole file at once')
+    parser.add_argument('--batch', action='store_true',
+                        help='process many input files, writing one output per input')
+    parser.add_argument('--suffix', default='_speed',
+                        help='added to the name of each input to name its output in --batch mode')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help='number of files to process at once in --batch mode. Defaults to the number of CPUs')
+    parser.add_argument('--chunksizes', type=parse_chunksizes, default=None,
+                        help='comma separated netCDF4 chunk shape for the derived variables, one size per dimension (e.g. 365,10,10 for fast time series reads)')
+    parser.add_argument('--complevel', type=int, default=0, choices=range(10),
+                        help='zlib compression level for the derived variables, 0 for no compression')
+    parser.add_argument('--no-shuffle', dest='shuffle', action='store_false',
+                        help='turn off the HDF5 shuffle filter when compressing the derived variables')
+    parser.add_argument('--least-significant-digit', type=int, default=None,
+                        help='keep every variable in --derive only to this many decimal places, so they compress better. '
+                             'The same number applies to all of them, whatever their units')
+    args = parser.parse_args()
+
+    encoding = derived_encoding(args.chunksizes, args.complevel, args.shuffle,
+                                args.least_significant_digit)
+
+    # The history entry is the same for every file in this run
+    history = create_history()
+
+    if not args.batch:
+        process_file(args.inFile, args.uVar, args.vVar, args.outfile_name, args.chunk, history, encoding,
+                     args.derive)
+        return
+
+    inFiles = expand_inputs(args.inFile)
+    if not inFiles:
+        parser.error('no input files match %s' %(args.inFile))
+    if not os.path.isdir(args.outfile_name):
+        os.makedirs(args.outfile_name)
+
+    jobs = []
+    for inFile in inFiles:
+        base, ext = os.path.splitext(os.path.basename(inFile))
+        outfile_name = os.path.join(args.outfile_name, base + args.suffix + ext)
+        jobs.append((inFile, args.uVar, args.vVar, outfile_name, args.chunk, history, encoding,
+                     args.derive))
+
+    failed = 0
+    pool = multiprocessing.Pool(args.processes)
+    try:
+        for inFile, seconds, error in pool.imap_unordered(_process_job, jobs):
+            if error is None:
+                report_throughput(inFile, seconds)
+            else:
+                failed += 1
+                sys.stderr.write('%s: failed after %.2f s: %s\n' %(inFile, seconds, error))
+    finally:
+        pool.close()
+        pool.join()
+
+    if failed:
+        sys.exit('%d of %d files failed' %(failed, len(jobs)))
+
+
+def parse_derived(text):
+    """Turn a comma separated list of derived variable names into a list, checking they are registered"""
+
+    names = [name.strip() for name in text.split(',')]
+    for name in names:
+        if name not in DERIVED:
+            raise argparse.ArgumentTypeError('unknown derived variable %s, choose from %s'
+                                             %(name, ', '.join(sorted(DERIVED))))
+    return names
+
+
+def parse_chunksizes(text):
+    """Turn a comma separated list of chunk sizes into a tuple of ints"""
+
+    return tuple(int(size) for size in text.split(','))
+
+
+def derived_encoding(chunksizes=None, complevel=0, shuffle=True, least_significant_digit=None):
+    """Keyword arguments for createVariable that set the chunking and compression of the derived variables"""
+
+    encoding = {}
+    if chunksizes is not None:
+        encoding['chunksizes'] = chunksizes
+    if complevel:
+        encoding['zlib'] = True
+        encoding['complevel'] = complevel
+        encoding['shuffle'] = shuffle
+    if least_significant_digit is not None:
+        encoding['least_significant_digit'] = least_significant_digit
+
+    return encoding
+
+
+def expand_inputs(pattern):
+    """List the input files given by a glob pattern, or by a file of names if pattern is @FILE"""
+
+    if pattern.startswith('@'):
+        with open(pattern[1:]) as listfile:
+            return [line.strip() for line in listfile if line.strip()]
+
+    return sorted(glob.glob(pattern))
+
+
+def process_file(inFile, uVar, vVar, outfile_name, chunk=None, history=None, encoding=None,
+                 names=('SPCUR',)):
+    """Calculate the derived variables in names for inFile and write them to outfile_name.
+
+    encoding holds extra createVariable arguments for the derived variables,
+    from derived_encoding. Returns the number of seconds it took.
+
+    """
+
+    start_time = time.time()
+
+    input_DATA = Dataset(inFile)
     
     # Write the output file
     outfile = Dataset(outfile_name, 'w', format='NETCDF4')
-    set_global_atts(input_DATA, outfile)
+    set_global_atts(input_DATA, outfile, history)
     copy_dimensions(input_DATA, outfile)
     copy_variables(input_DATA, outfile)
-    write_speed(input_DATA, outfile, spData) 
+    write_derived(input_DATA, outfile, uVar, vVar, names, chunk, encoding)
     
     outfile.close()
+    input_DATA.close()
+
+    return time.time() - start_time
+
+
+def _process_job(job):
+    """Run process_file on one job from main.
+
+    Returns the input file, how long it took, and a description of the
+    error that stopped it, or None if it worked. Errors are caught here so
+    that one bad input doesn't stop the rest of the batch.
+
+    """
+
+    start_time = time.time()
+    try:
+        return job[0], process_file(*job), None
+    except Exception as error:
+        return job[0], time.time() - start_time, '%s: %s' %(type(error).__name__, error)
+
+
+def report_throughput(inFile, seconds):
+    """Print how fast inFile was processed, in MB of input per second if it is a local file"""
+
+    if not os.path.isfile(inFile):
+        # OPeNDAP URLs have no size on disk to measure
+        print('%s: %.2f s' %(inFile, seconds))
+        return
+
+    megabytes = os.path.getsize(inFile) / 1e6
+    rate = megabytes / seconds if seconds > 0 else float('inf')
+    print('%s: %.1f MB in %.2f s (%.1f MB/s)' %(inFile, megabytes, seconds, rate))
     
 
-def read_data(ifile, uVar, vVar):
-    """Read data from ifile corresponding to the U and V variable"""
+# Variables that can be derived from the U and V components, by output
+# variable name. Each entry holds the function that calculates it and the
+# attributes to give it; add new ones with the register_derived decorator.
+DERIVED = {}
+
+
+def register_derived(name, standard_name, long_name, units=None):
+    """Register a function as the way to calculate the output variable name.
 
-    input_DATA = Dataset(ifile)
-    uData = input_DATA.variables[uVar][:]
-    vData = input_DATA.variables[vVar][:]
+    The function is called as func(u, v, out) with blocks of the U and V
+    data, and must write its result into out, an array of the same shape,
+    and return it. If out is None it should return a new array instead.
+    units defaults to the units of U.
 
-    return uData, vData, input_DATA
+    """
+
+    def register(func):
+        DERIVED[name] = {'func': func,
+                         'standard_name': standard_name,
+                         'long_name': long_name,
+                         'units': units}
+        return func
+
+    return register
 
 
-def calc_speed(u, v):
+@register_derived('SPCUR', 'sea_water_speed', 'sea water speed')
+def calc_speed(u, v, out=None):
     """Calculate the speed"""
 
-    speed = (u**2 + v**2)**0.5
+    # hypot is (u**2 + v**2)**0.5 without the temporary arrays
+    speed = np.hypot(u, v, out=out)
 
     return speed
 
 
+@register_derived('CDIR', 'direction_of_sea_water_velocity', 'direction of sea water velocity',
+                  units='degree')
+def calc_direction(u, v, out=None):
+    """Calculate the direction the current flows towards, in degrees clockwise from north"""
+
+    direction = np.arctan2(u, v, out=out)
+    np.degrees(direction, out=direction)
+    np.mod(direction, 360, out=direction)
+
+    return direction
+
+
+@register_derived('KE', 'specific_kinetic_energy_of_sea_water', 'kinetic energy per unit mass of sea water',
+                  units='m2 s-2')
+def calc_kinetic_energy(u, v, out=None):
+    """Calculate the kinetic energy per unit mass, (u**2 + v**2) / 2"""
+
+    energy = np.hypot(u, v, out=out)
+    np.square(energy, out=energy)
+    energy *= 0.5
+
+    return energy
+
+
 def copy_dimensions(infile, outfile):
     """Copy the dimensions of the infile to the outfile"""
         
-    for dimName, dimData in infile.dimensions.iteritems():
+    for dimName, dimData in infile.dimensions.items():
         outfile.createDimension(dimName, len(dimData))
 
 
-def set_global_atts(infile, outfile):
+def set_global_atts(infile, outfile, new_history=None):
     """Set the global attributes for outfile.
         
     Note that the global attributes are simply copied from
     infile and the history attribute updated accordingly.
+    new_history is the entry to add, from create_history
+    if not given.
         
     """
         
@@ -66,7 +259,8 @@ def set_global_atts(infile, outfile):
     for att in infile.ncattrs():
         global_atts[att] = eval('infile.'+att)  
         
-    new_history = create_history()
+    if new_history is None:
+        new_history = create_history()
     global_atts['history'] = """%s\n%s""" %(new_history,  global_atts['history'])
     outfile.setncatts(global_atts)
 
@@ -100,17 +294,66 @@ def copy_variables(infile, outfile):
         outVar.setncatts(var_atts)
 
 
-def write_speed(infile, outfile, spData):
-    """Write the current speed data to outfile"""
-        
-    u = infile.variables['UCUR']   
-    spcur = outfile.createVariable('SPCUR', u.datatype, u.dimensions, fill_value=u._FillValue)
-    spcur[:,:,:] = spData    
-    
-    spcur.standard_name = 'sea_water_speed'
-    spcur.long_name = 'sea water speed'
-    spcur.units = u.units
-    spcur.coordinates = u.coordinates
-    
+def create_derived(infile, outfile, name, uVar='UCUR', encoding=None):
+    """Create the derived variable name in outfile, using uVar as a template.
+
+    encoding holds extra createVariable arguments, such as chunksizes,
+    zlib, complevel, shuffle and least_significant_digit.
+
+    """
+
+    u = infile.variables[uVar]
+    derived = DERIVED[name]
+    outVar = outfile.createVariable(name, u.datatype, u.dimensions, fill_value=u._FillValue,
+                                    **(encoding or {}))
+
+    outVar.standard_name = derived['standard_name']
+    outVar.long_name = derived['long_name']
+    outVar.units = derived['units'] or u.units
+    outVar.coordinates = u.coordinates
+
+    return outVar
+
+
+def write_derived(infile, outfile, uVar, vVar, names, chunk=None, encoding=None):
+    """Calculate the derived variables in names and write them to outfile.
+
+    U and V are read once, chunk time steps at a time (or all at once if
+    chunk is None), and every derived variable is calculated from each
+    block before the next is read. Each variable is calculated straight
+    into its own buffer, which is reused for every block.
+
+    """
+
+    u = infile.variables[uVar]
+    v = infile.variables[vVar]
+    outVars = [create_derived(infile, outfile, name, uVar, encoding) for name in names]
+
+    nTime = u.shape[0]
+    if chunk is None:
+        chunk = max(nTime, 1)
+
+    buffers = None
+    for start in range(0, nTime, chunk):
+        stop = min(start + chunk, nTime)
+        uBlock = u[start:stop]
+        vBlock = v[start:stop]
+
+        if buffers is None:
+            shape = (min(chunk, nTime),) + uBlock.shape[1:]
+            dtype = np.result_type(uBlock, vBlock)
+            buffers = [np.empty(shape, dtype=dtype) for name in names]
+
+        # Keep points where either component is missing as missing
+        missing = np.ma.getmaskarray(uBlock) | np.ma.getmaskarray(vBlock)
+        uBlock = np.ma.getdata(uBlock)
+        vBlock = np.ma.getdata(vBlock)
+
+        for name, outVar, buffer in zip(names, outVars, buffers):
+            block = buffer[:stop - start]
+            DERIVED[name]['func'](uBlock, vBlock, out=block)
+            outVar[start:stop] = np.ma.array(block, mask=missing)
+
 
-main()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Times reformat_weather_data.unstack_data against the old approach of
+building a Period for every row from a formatted string, month by month.
+
+The input is synthetic: a number of "stations", each with a Met Office
+style ranked file covering several centuries.
+
+    python benchmark_reformat.py --years 500 --stations 50
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import timeit
+
+import numpy as np
+import pandas as pd
+
+from reformat_weather_data import MONTHS, unstack_data
+
+parser = argparse.ArgumentParser(description='Benchmark the reshape done by reformat_weather_data.py on synthetic data.')
+parser.add_argument('--years', type=int, default=500, help='Number of years in each synthetic file.')
+parser.add_argument('--stations', type=int, default=50, help='Number of synthetic files.')
+parser.add_argument('--repeat', type=int, default=3, help='Number of timings to take the best of.')
+
+HEADER_LINES = ['Synthetic Mean Temperature (Degrees C)',
+                'Areal series, starting from 1500',
+                'Generated by benchmark_reformat.py',
+                'Seasons: Winter=Dec-Feb, Spring=Mar-May, Summer=June-Aug, Autumn=Sept-Nov.',
+                'Monthly values are ranked and displayed to 1 dp.',
+                'Not real data.',
+                '']
+
+def write_station(path, n_years, rng):
+    """Write a ranked Met Office style file with n_years rows"""
+
+    columns = []
+    for name in MONTHS + ['WIN', 'SPR', 'SUM', 'AUT', 'ANN']:
+        values = np.sort(rng.normal(10, 4, n_years))[::-1]
+        years = rng.permutation(np.arange(1500, 1500 + n_years))
+        columns += [values, years]
+
+    with open(path, 'w') as f:
+        f.write('\n'.join(HEADER_LINES) + '\n')
+        f.write('\t' + '\t'.join('{0}\tYear'.format(name) for name in MONTHS + ['WIN', 'SPR', 'SUM', 'AUT', 'ANN']) + '\n')
+        for row in zip(*columns):
+            f.write('\t' + '\t'.join('{0:.1f}\t{1}'.format(row[i], row[i + 1]) for i in range(0, len(row), 2)) + '\n')
+
+def unstack_data_by_month(full_data):
+    """The old reshape: one Period per row parsed from a string, one frame per month"""
+
+    monthly_data = []
+    for i in range(0, 24, 2):
+        month_data = full_data.iloc[:, i:i+2].copy()
+        month = month_data.columns[0]
+        month_data.index = [pd.Period('{0} {1}'.format(month, year), freq='M')
+                            for year in month_data.iloc[:, 1]]
+        month_data.columns = ['value', 'year']
+        month_data.index.name = 'month'
+        monthly_data.append(month_data.drop('year', axis=1))
+
+    return pd.concat(monthly_data).sort_index()
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(42)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        frames = []
+        for station in range(args.stations):
+            path = os.path.join(tmp_dir, 'station_{0}.txt'.format(station))
+            write_station(path, args.years, rng)
+            frames.append(pd.read_csv(path, sep=r'\s+', skiprows=7))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    # Check the vectorized reshape gives the same months and values as the old loop
+    expected = unstack_data_by_month(frames[0])
+    actual = unstack_data(frames[0])
+    assert (expected.index == actual.index).all()
+    assert np.allclose(expected['value'].values, actual['value'].values)
+
+    print('{0} stations x {1} years ({2} monthly values)'.format(
+        args.stations, args.years, args.stations * args.years * len(MONTHS)))
+
+    for name, func in [('per-month loop', unstack_data_by_month),
+                       ('vectorized', unstack_data)]:
+        best = min(timeit.repeat(lambda: [func(frame) for frame in frames],
+                                 number=1, repeat=args.repeat))
+        print('{0:>15}: {1:.3f} s'.format(name, best))
@@ -0,0 +1,105 @@
+
+# cached_download_data.py
+
+# A version of rainfall_data.py that downloads with python instead of wget.
+# All downloads share one pool of connections, and the server is asked
+# whether each file has changed since it was last downloaded, using the
+# ETag and Last-Modified headers saved in doit's value store. Files that
+# haven't changed are not downloaded again.
+#
+# Run with "doit -f doit_examples/cached_download_data.py -d . -n 4 -P thread"
+# to fetch the files at the same time. Set MET_OFFICE_URL to download
+# from somewhere else, like a local test server.
+
+import os
+import requests
+
+data_sets = ['Tmean', 'Sunshine', 'Rainfall']
+
+base_url = os.environ.get('MET_OFFICE_URL', 'http://www.metoffice.gov.uk/climate/uk/datasets')
+
+# One session for every download, so connections are kept open and reused
+session = requests.Session()
+session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=len(data_sets)))
+session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=len(data_sets)))
+
+def get_data_file_parameters(data_type):
+    """Takes a string describing the type of climate data, returns url and file name for that data"""
+
+    data_url = '{0}/{1}/ranked/UK.txt'.format(base_url, data_type)
+    data_target = 'UK_{0}_data.txt'.format(data_type)
+    return data_url, data_target
+
+def conditional_headers(values):
+    """Turn the validators saved by download() into headers for a conditional request"""
+    headers = {}
+    if values.get('etag'):
+        headers['If-None-Match'] = values['etag']
+    if values.get('last_modified'):
+        headers['If-Modified-Since'] = values['last_modified']
+    return headers
+
+class remote_unchanged(object):
+    """
+    uptodate checker: the task is up to date if the server says url
+    hasn't changed since the ETag or Last-Modified time doit saved when
+    it was last downloaded.
+    """
+
+    def __init__(self, url):
+        self.url = url
+
+    def __call__(self, task, values):
+        headers = conditional_headers(values)
+        if not headers:
+            return False
+        try:
+            response = session.head(self.url, headers=headers, timeout=30)
+        except requests.RequestException:
+            # Can't ask the server, so keep the copy we have
+            return True
+        return response.status_code == 304
+
+def download(url, target):
+    """
+    Downloads url to target. Returns the response's ETag and Last-Modified
+    headers, which doit saves for remote_unchanged to use next time.
+    """
+
+    response = session.get(url, stream=True, timeout=30)
+    response.raise_for_status()
+
+    # Write to a temporary file first so a failed download doesn't leave half a file
+    partial = target + '.part'
+    with open(partial, 'wb') as f:
+        for chunk in response.iter_content(64 * 1024):
+            f.write(chunk)
+    if os.path.exists(target):
+        os.remove(target)
+    os.rename(partial, target)
+
+    return {'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified')}
+
+def task_download_data():
+    """Downloads all raw data files from the Met Office website"""
+
+    for data_type in data_sets:
+        data_url, data_target = get_data_file_parameters(data_type)
+        yield {
+            'actions': [(download, [data_url, data_target])],
+            'targets': [ data_target ],
+            'name' : data_type,
+            'uptodate': [remote_unchanged(data_url)],
+        }
+
+def task_reformat_data():
+    """Reformats all raw files for easier analysis"""
+
+    for data_type in data_sets:
+        yield {
+            'actions': ['python reformat_weather_data.py %(dependencies)s > %(targets)s'],
+            'file_dep': ['UK_{}_data.txt'.format(data_type)],
+            'targets': ['UK_{}_data.reformatted.txt'.format(data_type)],
+            'name': 'UK_{}_data.txt'.format(data_type),
+        }
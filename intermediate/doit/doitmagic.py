@@ -8,6 +8,29 @@ Usage:
 def task_example():
     return { 'actions' : ['echo "Hello world!"'] }
 
+doit_args are passed on to doit, starting with the doit command if
+there is one. To run independent tasks in parallel, give doit a
+process count, e.g. "%%doit run -n 4" or "%%doit -n 4 -P thread".
+
+Every cell is written to a new temporary file, so the record of which
+tasks are up to date is kept in one dep-file per notebook
+(.<notebook>.doit.db in the working directory, or .doit.db if the
+notebook name isn't known). Tasks whose file_dep contents and targets
+haven't changed since an earlier cell are skipped. Pass --db-file to
+use a different dep-file.
+
+Output from doit is shown as it arrives rather than when doit exits,
+followed by a rough summary of how long each task that ran took. The
+summary is left out when tasks run in parallel, since they overlap.
+
+By default doit runs in a new process, which is the safest choice
+because nothing in the cell can affect the notebook's kernel. Adding
+--in-process to doit_args instead loads the cell as a module and runs
+its tasks through doit's python API inside the kernel, which saves
+starting python and re-importing everything on every cell:
+
+%%doit --in-process run
+
 """
 
 # This file is copyright 2014 by Rob Beagrie: see
@@ -18,12 +41,96 @@ def task_example():
 
 from tempfile import NamedTemporaryFile
 from subprocess import Popen, PIPE
+from threading import Thread
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+import itertools
+import linecache
 import signal
 import time
+import types
 import sys
 import os
 from IPython.core.magic import Magics, magics_class, cell_magic
-from IPython.utils import py3compat
+
+# How many lines of output may wait to be written to the notebook before
+# the threads reading doit's output stop reading
+MAX_QUEUED_LINES = 1000
+
+def enqueue_lines(stream, name, queue):
+    """Put each line of stream on queue as it arrives, then None when it closes"""
+    for line in iter(stream.readline, b''):
+        queue.put((name, line))
+    stream.close()
+    queue.put((name, None))
+
+def doit_processes(doit_args):
+    """The number of processes doit_args ask doit to run tasks in"""
+    for i, arg in enumerate(doit_args):
+        value = None
+        if arg in ('-n', '--process') and i + 1 < len(doit_args):
+            value = doit_args[i + 1]
+        elif arg.startswith('--process='):
+            value = arg[len('--process='):]
+        elif arg.startswith('-n') and len(arg) > 2:
+            value = arg[2:]
+        if value is not None:
+            try:
+                return int(value)
+            except ValueError:
+                pass
+    return 1
+
+class TaskTimer(object):
+    """
+    Roughly times tasks from doit's progress lines. doit prints ".  name"
+    when it starts a task and "-- name" when it skips one, so a task is
+    taken to last until the next progress line, or until doit exits.
+    That is only right when tasks run one at a time.
+    """
+
+    def __init__(self):
+        self.times = []
+        self._running = None
+
+    def _finish(self, now):
+        if self._running is not None:
+            name, started = self._running
+            self.times.append((name, now - started))
+            self._running = None
+
+    def feed(self, line):
+        now = time.time()
+        if line.startswith('.  '):
+            self._finish(now)
+            self._running = (line[3:].strip(), now)
+        elif line.startswith('-- ') or line.startswith('!! '):
+            self._finish(now)
+
+    def summary(self):
+        self._finish(time.time())
+        if not self.times:
+            return ''
+        width = max(len(name) for name, _ in self.times)
+        lines = ['{0:<{1}}  {2:8.2f}s'.format(name, width, seconds)
+                 for name, seconds in self.times]
+        return 'Approximate task times:\n' + '\n'.join(lines) + '\n'
+
+class TimedStream(object):
+    """Passes doit's output on to stream, feeding it to a TaskTimer on the way"""
+
+    def __init__(self, stream, timer):
+        self._stream = stream
+        self._timer = timer
+
+    def write(self, text):
+        self._timer.feed(text)
+        self._stream.write(text)
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
 
 @magics_class
 class DoitMagic(Magics):
@@ -38,29 +145,115 @@ class DoitMagic(Magics):
         """
         super(DoitMagic, self).__init__(shell)
         self._temp_file = NamedTemporaryFile()
+        self._cell_count = itertools.count(1)
+
+    def _dep_file(self, cur_dir):
+        """Path of the doit dep-file shared by every cell in this notebook"""
+
+        # Recent ipykernels record the notebook's path in __session__
+        notebook = self.shell.user_ns.get('__session__') if self.shell else None
+        if notebook:
+            name = os.path.splitext(os.path.basename(notebook))[0]
+            return os.path.join(cur_dir, '.{0}.doit.db'.format(name))
+        return os.path.join(cur_dir, '.doit.db')
+
+    def _run_in_process(self, doit_command, doit_args, cell):
+        """Run the tasks defined in cell with doit's python API, inside the kernel"""
+        from doit.cmd_base import ModuleTaskLoader
+        from doit.doit_cmd import DoitMain
+
+        # doit orders tasks by where they are defined, so it needs to
+        # find the cell's source the way it would find a file's
+        filename = '<doit cell {0}>'.format(next(self._cell_count))
+        linecache.cache[filename] = (len(cell), None, cell.splitlines(True), filename)
+
+        module = types.ModuleType('doit_cell')
+        exec(compile(cell, filename, 'exec'), module.__dict__)
+
+        # Send doit's progress lines through the timer, unless the cell
+        # asks for them to go somewhere else or tasks will overlap
+        timer = TaskTimer()
+        config = module.__dict__.setdefault('DOIT_CONFIG', {})
+        if doit_processes(doit_args) == 1:
+            config.setdefault('outfile', TimedStream(sys.stdout, timer))
+
+        DoitMain(ModuleTaskLoader(module)).run(doit_command + doit_args)
+
+        sys.stdout.write(timer.summary())
+        sys.stdout.flush()
 
     @cell_magic
     def doit(self, doit_args, cell):
-        with NamedTemporaryFile(delete=False, suffix='.py') as tmp_file:
-            tmp_name = tmp_file.name
-            tmp_file.write(cell)
-
         cur_dir = os.getcwd()
         doit_args = doit_args.split()
-        if doit_args:
+
+        in_process = '--in-process' in doit_args
+        if in_process:
+            doit_args.remove('--in-process')
+
+        # "%%doit -n 4" has options but no command, so doit runs its default
+        if doit_args and not doit_args[0].startswith('-'):
             doit_command = [doit_args.pop(0)]
         else:
             doit_command = []
 
+        if '--db-file' not in doit_args:
+            doit_args = ['--db-file', self._dep_file(cur_dir)] + doit_args
+
+        if in_process:
+            return self._run_in_process(doit_command, doit_args, cell)
+
+        with NamedTemporaryFile(delete=False, suffix='.py') as tmp_file:
+            tmp_name = tmp_file.name
+            tmp_file.write(cell.encode('utf-8'))
+
+        try:
+            self._run_subprocess(doit_command, doit_args, cur_dir, tmp_name)
+        finally:
+            os.remove(tmp_name)
+
+    def _run_subprocess(self, doit_command, doit_args, cur_dir, tmp_name):
+        """Run the tasks in the file tmp_name with doit in a new process, streaming its output"""
+
         cmd = ['doit']
         cmd += doit_command
         cmd += [ '-d', cur_dir, '-f', tmp_name]
         cmd += doit_args
 
-        p = Popen(cmd, stdout=PIPE, stderr=PIPE)
+        # doit's output is a pipe, so ask python not to hold it back in a buffer
+        env = dict(os.environ, PYTHONUNBUFFERED='1')
+        p = Popen(cmd, stdout=PIPE, stderr=PIPE, env=env)
 
+        # Read both streams in the background so neither can fill up and block doit
+        queue = Queue(maxsize=MAX_QUEUED_LINES)
+        outputs = {'stdout': sys.stdout, 'stderr': sys.stderr}
+        for name, stream in [('stdout', p.stdout), ('stderr', p.stderr)]:
+            reader = Thread(target=enqueue_lines, args=(stream, name, queue))
+            reader.daemon = True
+            reader.start()
+
+        # Tasks run in parallel overlap, so they can't be timed from progress lines
+        timed = doit_processes(doit_args) == 1
+        timer = TaskTimer()
+        open_streams = len(outputs)
         try:
-            out, err = p.communicate(cell)
+            while open_streams:
+                # Wake up regularly so KeyboardInterrupt isn't held up
+                try:
+                    name, line = queue.get(timeout=0.1)
+                except Empty:
+                    continue
+
+                if line is None:
+                    open_streams -= 1
+                    continue
+
+                line = line.decode('utf-8', 'replace')
+                if name == 'stdout' and timed:
+                    timer.feed(line)
+                outputs[name].write(line)
+                outputs[name].flush()
+            p.wait()
         except KeyboardInterrupt:
             try:
                 p.send_signal(signal.SIGINT)
@@ -82,15 +275,8 @@ class DoitMagic(Magics):
                     % (p.pid, e))
             return
 
-        out = py3compat.bytes_to_str(out)
-        err = py3compat.bytes_to_str(err)
-
-        sys.stdout.write(out)
+        sys.stdout.write(timer.summary())
         sys.stdout.flush()
-        sys.stderr.write(err)
-        sys.stderr.flush()
-
-        os.remove(tmp_name)
 
 def load_ipython_extension(ipython):
     ipython.register_magics(DoitMagic)
@@ -1,29 +1,34 @@
+import numpy as np
 import pandas as pd
 import argparse
+import multiprocessing
+import os
 import sys
 
+# Columnar formats that can be written in place of csv
+BINARY_FORMATS = ['npz', 'feather', 'parquet']
+
 parser = argparse.ArgumentParser(description='Reformats a met-office weather data file. Input data has one row per year and one column per month. Output data has a date column and a value column.')
-parser.add_argument('data_file',metavar='DATA_FILE', help='Data file containing met office weather stats.')
+parser.add_argument('data_file',metavar='DATA_FILE', nargs='?', help='Data file containing met office weather stats.')
+parser.add_argument('--batch', nargs=2, action='append', default=[], metavar=('DATA_FILE', 'OUTPUT_FILE'),
+        help='Reformat DATA_FILE into OUTPUT_FILE. Repeat to reformat many files in one run.')
+parser.add_argument('-j', '--processes', type=int, default=None,
+        help='Number of worker processes for --batch. Defaults to the number of CPUs.')
+parser.add_argument('--format', choices=['csv'] + BINARY_FORMATS, default=None,
+        help='Output format for --batch. Defaults to the extension of each OUTPUT_FILE, or csv. The binary formats keep the monthly periods and float values so they can be loaded with load_reformatted without parsing dates; feather and parquet need pyarrow.')
+parser.add_argument('--stream', action='store_true',
+        help='Write records for each input row as soon as it is read, in the order of the input file, instead of loading the whole file and sorting it by date.')
 
-def get_month_data(month_data):
-    """Takes a two column DataFrame and returns a one column DataFrame where the index is a pandas period""" 
-    
-    # Each pair of columns contains data for a specific month. What month is this?
-    month = month_data.columns[0]
-        
-    # Given a year, return a Period object representing this month in that year
-    def get_period(year):
-        return pd.Period('{0} {1}'.format(month,year))
-    
-    # Change the index of the dataframe to be the monthly period
-    month_data.index = map(get_period, full_data.iloc[:,2])
-    
-    # Rename the columns
-    month_data.columns = ['value', 'year']
-    month_data.index.name = 'month'
-        
-    # Remove the year column, we don't need it anymore.
-    return month_data.drop('year', axis=1)
+MONTHS = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN',
+          'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']
+
+def period_index(years, months):
+    """Build a monthly PeriodIndex straight from integer year and month arrays"""
+    try:
+        return pd.PeriodIndex.from_fields(year=years, month=months, freq='M')
+    except AttributeError:
+        # Older pandas takes the fields in the constructor
+        return pd.PeriodIndex(year=years, month=months, freq='M')
 
 def unstack_data(full_data):
     """
@@ -31,27 +36,174 @@ def unstack_data(full_data):
     dataframe where each row is a specific month of a specific year.
     """
 
-    # Loop over columns of the DataFrame in groups of 2
-    # and feed them to get_month_data
-    monthly_data = [ get_month_data(full_data.iloc[:, i:i+2]) for i in range(1,25,2)]
+    # Each month has a value column followed by a year column, starting at JAN.
+    # Take the 12 pairs as one block so each row of the block is one rank.
+    first = full_data.columns.get_loc('JAN')
+    block = full_data.iloc[:, first:first + 2 * len(MONTHS)].values.astype(float)
+
+    # Reading the block row by row gives (value, year) pairs for JAN..DEC in turn
+    values = block[:, 0::2].ravel()
+    years = block[:, 1::2].ravel()
+    months = np.tile(np.arange(1, len(MONTHS) + 1), len(block))
+
+    # Months that haven't happened yet have no year
+    present = ~np.isnan(years)
+    years = years[present].astype(int)
+    months = months[present]
+    values = values[present]
+
+    # Sort on year then month with a single integer key
+    order = np.argsort(years * len(MONTHS) + months, kind='mergesort')
+
+    index = period_index(years[order], months[order])
+    index.name = 'month'
+    return pd.DataFrame({'value': values[order]}, index=index)
+
+def stream_records(lines):
+    """
+    Takes the lines of a met office file and yields (year, month, value) for
+    each month of each row as it is read, so only one row is held at a time.
+
+    Ranked files have a value and a year column per month, so their records
+    come out in rank order. Files ordered by date start with a single Year
+    column followed by one column per month, and come out in date order.
+    """
+
+    lines = iter(lines)
+
+    # Skip the description at the top of the file
+    for _ in range(7):
+        next(lines)
+    by_date = next(lines).split()[0] == 'Year'
+
+    for line in lines:
+        fields = line.split()
+        if not fields:
+            continue
+
+        if by_date:
+            year = fields[0]
+            pairs = [(value, year) for value in fields[1:len(MONTHS) + 1]]
+        else:
+            pairs = zip(fields[0:2 * len(MONTHS):2], fields[1:2 * len(MONTHS):2])
+
+        for month, (value, year) in enumerate(pairs, 1):
+            # Months that haven't happened yet are blank or marked with dashes
+            try:
+                yield int(year), month, float(value)
+            except ValueError:
+                continue
+
+def write_records(records, output):
+    """Write (year, month, value) records in the same CSV layout as write_data"""
+    output.write('month,value\n')
+    for year, month, value in records:
+        output.write('{0:04d}-{1:02d}-01,{2!r}\n'.format(year, month, value))
+
+def read_data(data_file):
+    """Read a met office data file into a DataFrame with one row per rank"""
+    return pd.read_csv(data_file, sep=r'\s+', skiprows=7)
+
+def output_format(output_file):
+    """Choose an output format from the extension of output_file, defaulting to csv"""
+    extension = os.path.splitext(output_file)[1][1:].lower()
+    return extension if extension in BINARY_FORMATS else 'csv'
+
+def write_data(unstacked_data, output, fmt='csv'):
+    """
+    Write the reformatted data to output.
+
+    csv dates each month by its first day. npz stores integer year and month
+    columns next to the values, feather and parquet store the periods as they are.
+    """
+
+    if fmt == 'csv':
+        unstacked_data.to_timestamp().to_csv(output)
+    elif fmt == 'npz':
+        index = unstacked_data.index
+        np.savez(output, year=np.asarray(index.year), month=np.asarray(index.month),
+                 value=unstacked_data['value'].values)
+    elif fmt == 'feather':
+        # feather can't store an index, so keep the periods as a column
+        unstacked_data.reset_index().to_feather(output)
+    elif fmt == 'parquet':
+        unstacked_data.to_parquet(output)
+    else:
+        raise ValueError('Unknown output format: {0}'.format(fmt))
+
+def load_reformatted(path):
+    """
+    Load a file written by write_data, choosing the format from its extension.
+    Returns a DataFrame with a monthly PeriodIndex and a value column.
+    """
+
+    fmt = output_format(path)
+    if fmt == 'npz':
+        with np.load(path) as data:
+            index = period_index(data['year'], data['month'])
+            index.name = 'month'
+            return pd.DataFrame({'value': data['value']}, index=index)
+    elif fmt == 'feather':
+        return pd.read_feather(path).set_index('month')
+    elif fmt == 'parquet':
+        return pd.read_parquet(path)
+    else:
+        return pd.read_csv(path, index_col='month', parse_dates=True).to_period('M')
+
+def reformat_file(data_file, output_file, fmt=None):
+    """
+    Reformats data_file and writes the result to output_file, in the format
+    given by fmt or by the extension of output_file.
+
+    This does the same job as running the script, without starting a new
+    python, so it can be used directly as a doit python-action:
+
+        'actions': [(reformat_file, ['UK_Tmean_data.txt', 'UK_Tmean_data.reformatted.txt'])]
+    """
+    if fmt is None:
+        fmt = output_format(output_file)
+    write_data(unstack_data(read_data(data_file)), output_file, fmt)
+
+def _reformat_pair(pair):
+    """Reformat one (data_file, output_file, fmt) job from reformat_files"""
+    reformat_file(*pair)
 
-    # Add all the data for the individual months together
-    unstacked_data = pd.concat(monthly_data)
+def reformat_files(pairs, processes=None, fmt=None):
+    """Reformats each (data_file, output_file) pair, spreading them over a pool of processes"""
 
-    return unstacked_data.sort()
+    pairs = [(data_file, output_file, fmt) for data_file, output_file in pairs]
+    if len(pairs) < 2 or processes == 1:
+        for pair in pairs:
+            _reformat_pair(pair)
+        return
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        pool.map(_reformat_pair, pairs)
+    finally:
+        pool.close()
+        pool.join()
 
 if __name__ == '__main__':
 
     args = parser.parse_args()
 
-    full_data = pd.read_csv(args.data_file, delim_whitespace=True,
-            skiprows=7)
+    if args.data_file is None and not args.batch:
+        parser.error('give a DATA_FILE or at least one --batch DATA_FILE OUTPUT_FILE')
+
+    # Batch pairs all share this process's pandas import
+    reformat_files(args.batch, processes=args.processes, fmt=args.format)
 
-    unstacked_data = unstack_data(full_data)
+    if args.data_file is None:
+        sys.exit(0)
 
-    # Write the new dataframe to stdout
+    # Write the new data to stdout
     try:
-        unstacked_data.to_csv(sys.stdout)
+        if args.stream:
+            with open(args.data_file) as data:
+                write_records(stream_records(data), sys.stdout)
+        else:
+            write_data(unstack_data(read_data(args.data_file)), sys.stdout)
 
     # Don't fall over if we pipe the output to head
     except IOError:
@@ -1,4 +1,4 @@
-""" 
+"""
 This script is intended to keep the example doit scripts
 in doit_examples/ in sync with the contents of the
 iPython notebooks used for teaching. It iterates over
@@ -6,41 +6,193 @@ all iPython notebooks in the current directory and looks
 for cells that contain the doit magic. If the first
 comment line contains a filename, it writes the contents
 of that cell to the relevant file in doit_examples/
+
+The modification time and hash of each notebook are saved
+in .sync_doit_examples.json, and notebooks that haven't
+changed since the last sync are skipped. Example files are
+only written when their contents change, so their timestamps
+stay put otherwise. Run with --force to look at every notebook.
+
+Both the nbformat 3 layout (cells inside worksheets) and the
+nbformat 4 layout (cells at the top level) are understood. If
+ijson is installed, notebooks are read as a stream so that large
+outputs such as embedded images are never all in memory at once.
+Many notebooks can be read in parallel with --processes.
 """
 
+import argparse
+import hashlib
+import multiprocessing
 import simplejson
 import os
 import glob
 
-# Iterate over notebooks in this directory
-for nbpath in glob.glob('0?-*.ipynb'):
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+STATE_FILE = '.sync_doit_examples.json'
+
+parser = argparse.ArgumentParser(description='Copy %%doit cells from the lesson notebooks into doit_examples/.')
+parser.add_argument('notebooks', nargs='*', default=['0?-*.ipynb'],
+                    help='Notebooks, or glob patterns for notebooks, to look in. Defaults to 0?-*.ipynb.')
+parser.add_argument('--force', action='store_true',
+                    help='Check every notebook, even if it is unchanged since the last sync.')
+parser.add_argument('-j', '--processes', type=int, default=1,
+                    help='Number of notebooks to read at once.')
+
+# Where cells live in the nbformat 4 and nbformat 3 layouts, as ijson prefixes
+CELL_PREFIXES = ('cells.item', 'worksheets.item.cells.item')
+
+def file_hash(path):
+    """Return the md5 hex digest of the contents of path"""
+    with open(path, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+def load_state():
+    """Read the mtime and hash of each notebook at the last sync"""
+    if not os.path.exists(STATE_FILE):
+        return {}
+    with open(STATE_FILE, 'r') as state_file:
+        return simplejson.load(state_file)
+
+def save_state(state):
+    with open(STATE_FILE, 'w') as state_file:
+        simplejson.dump(state, state_file, indent=2, sort_keys=True)
+
+def iter_cells(nbdata):
+    """Yield (cell_type, lines) for each cell of a notebook loaded with simplejson"""
+
+    if 'cells' in nbdata:
+        worksheets = [nbdata]
+    else:
+        worksheets = nbdata['worksheets']
+
+    for worksheet in worksheets:
+        for cell in worksheet['cells']:
+            # nbformat 3 calls the code "input", nbformat 4 calls it "source"
+            lines = cell.get('source', cell.get('input', []))
+            if not isinstance(lines, list):
+                lines = lines.splitlines(True)
+            yield cell['cell_type'], lines
+
+def stream_cells(nbfile):
+    """
+    Yield (cell_type, lines) for each cell of an open notebook file, reading
+    it with ijson. Only the type and code of one cell are kept at a time;
+    outputs are passed over as they are read.
+    """
+
+    cell = None
+    for prefix, event, value in ijson.parse(nbfile):
+        if prefix in CELL_PREFIXES:
+            if event == 'start_map':
+                cell = {'cell_type': None, 'lines': [], 'prefix': prefix}
+            elif event == 'end_map':
+                yield cell['cell_type'], cell['lines']
+                cell = None
+
+        elif cell is not None and event == 'string':
+            field = prefix[len(cell['prefix']) + 1:]
+            if field == 'cell_type':
+                cell['cell_type'] = value
+            elif field in ('input.item', 'source.item'):
+                cell['lines'].append(value)
+            elif field == 'source':
+                cell['lines'] = value.splitlines(True)
+
+def read_cells(nbpath):
+    """Return a list of (cell_type, lines) for the cells of the notebook at nbpath"""
+    with open(nbpath, 'rb') as nbfile:
+        if ijson is not None:
+            return list(stream_cells(nbfile))
+        return list(iter_cells(simplejson.load(nbfile)))
+
+def find_examples(cells):
+    """Yield (path, lines) for each %%doit cell that names its example file"""
+
+    for cell_type, lines in cells:
 
-    # Open notebook and load as json
-    with open(nbpath, 'r') as nbtxt:
-        nbdata = simplejson.load(nbtxt)
-        
-    # Iterate over cells
-    for cell in nbdata['worksheets'][0]['cells']:
-        
         # If a code cell, check if the first line starts with %%doit
-        if cell['cell_type'] == 'code':
-            lines = cell['input']
+        if cell_type == 'code':
             if lines and lines[0][:6] == '%%doit':
-                
+
                 # If it does, find the first comment line and check that it looks like a filename
                 for line in lines:
                     if line[0] == '#':
-                    
+
                         if line[-4:-1] == '.py':
 
                             # Extract the filename
                             fname = line[1:].strip()
-                            fpath = os.path.join('doit_examples', fname)
-
-                            print 'Found an example. Writing to {0}'.format(fpath)
-                            
-                            # Write the contents of the cell to the filename
-                            with open(fpath, 'w') as example_file:
-                                example_file.writelines(lines[1:])
-                            
+                            yield os.path.join('doit_examples', fname), lines[1:]
+
                         break
+
+def check_notebook(job):
+    """
+    Takes (nbpath, mtime, previous hash) and returns (nbpath, mtime, hash, examples).
+    examples is None when the notebook's hash hasn't changed.
+    """
+
+    nbpath, mtime, previous_hash = job
+    digest = file_hash(nbpath)
+    if digest == previous_hash:
+        return nbpath, mtime, digest, None
+    return nbpath, mtime, digest, list(find_examples(read_cells(nbpath)))
+
+def write_if_changed(fpath, lines):
+    """Write lines to fpath unless it already holds exactly that. Returns True if it wrote."""
+
+    contents = ''.join(lines)
+    if os.path.exists(fpath):
+        with open(fpath, 'r') as example_file:
+            if example_file.read() == contents:
+                return False
+
+    with open(fpath, 'w') as example_file:
+        example_file.write(contents)
+    return True
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+    state = {} if args.force else load_state()
+
+    nbpaths = sorted(set(path for pattern in args.notebooks for path in glob.glob(pattern)))
+
+    # Skip notebooks whose mtime hasn't changed without reading them at all
+    jobs = []
+    for nbpath in nbpaths:
+        mtime = os.path.getmtime(nbpath)
+        previous = state.get(nbpath, {})
+        if previous.get('mtime') != mtime:
+            jobs.append((nbpath, mtime, previous.get('hash')))
+
+    # Hash and read the rest, in parallel if asked. Results come back in
+    # order, so examples found in more than one notebook are written the same
+    # way each time.
+    if args.processes > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(args.processes)
+        results = pool.imap(check_notebook, jobs)
+    else:
+        pool = None
+        results = (check_notebook(job) for job in jobs)
+
+    for nbpath, mtime, digest, examples in results:
+        state[nbpath] = {'mtime': mtime, 'hash': digest}
+        if examples is None:
+            continue
+
+        for fpath, lines in examples:
+            if write_if_changed(fpath, lines):
+                print('Found an example. Writing to {0}'.format(fpath))
+            else:
+                print('Found an example. {0} is already up to date'.format(fpath))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    save_state(state)
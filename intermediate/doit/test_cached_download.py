@@ -0,0 +1,130 @@
+"""
+Checks doit_examples/cached_download_data.py against a local web server
+standing in for the Met Office, so it can run without the network:
+
+    python test_cached_download.py
+
+The server serves made-up data files from a temporary directory. The
+tests run doit on the example's download_data tasks, check that a second
+run skips files the server says haven't changed, and that changing a
+file on the server makes it download again.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+except ImportError:
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+    from SocketServer import ThreadingMixIn
+
+    class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DODO = os.path.join(HERE, 'doit_examples', 'cached_download_data.py')
+DATA_SETS = ['Tmean', 'Sunshine', 'Rainfall']
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    """Serves files from the server's root directory without logging every request"""
+
+    def translate_path(self, path):
+        # Python 2's handler has no directory argument, and always serves
+        # the current directory, so move what it finds there under root
+        path = SimpleHTTPRequestHandler.translate_path(self, path)
+        return os.path.join(self.server.root, os.path.relpath(path, os.getcwd()))
+
+    def log_message(self, format, *args):
+        pass
+
+def write_remote(remote_dir, data_type, text):
+    """Put a data file where the example expects to find data_type on the server"""
+    directory = os.path.join(remote_dir, data_type, 'ranked')
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(os.path.join(directory, 'UK.txt'), 'w') as f:
+        f.write(text)
+
+def start_server(remote_dir):
+    """Serve remote_dir on a free local port, returning the server and its url"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), QuietHandler)
+    server.root = remote_dir
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:{0}'.format(server.server_address[1])
+
+def run_doit(work_dir, url):
+    """Run the example's download tasks in work_dir, returning doit's output"""
+    env = dict(os.environ, MET_OFFICE_URL=url)
+    return subprocess.check_output(
+        [sys.executable, '-m', 'doit', '-f', DODO, '-d', work_dir,
+         '--db-file', os.path.join(work_dir, '.doit.db'), 'download_data'],
+        env=env, stderr=subprocess.STDOUT).decode('utf-8')
+
+def with_server(test):
+    """Run test(work_dir, remote_dir, url) with a fresh server and directories"""
+    remote_dir = tempfile.mkdtemp()
+    work_dir = tempfile.mkdtemp()
+    for data_type in DATA_SETS:
+        write_remote(remote_dir, data_type, '{0} version 1\n'.format(data_type))
+    server, url = start_server(remote_dir)
+    try:
+        test(work_dir, remote_dir, url)
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(remote_dir)
+        shutil.rmtree(work_dir)
+
+def check_first_run_downloads(work_dir, remote_dir, url):
+    output = run_doit(work_dir, url)
+    for data_type in DATA_SETS:
+        assert '.  download_data:{0}'.format(data_type) in output, output
+        with open(os.path.join(work_dir, 'UK_{0}_data.txt'.format(data_type))) as f:
+            assert f.read() == '{0} version 1\n'.format(data_type)
+
+def check_unchanged_files_skipped(work_dir, remote_dir, url):
+    run_doit(work_dir, url)
+    output = run_doit(work_dir, url)
+    for data_type in DATA_SETS:
+        assert '-- download_data:{0}'.format(data_type) in output, output
+
+def check_changed_file_downloaded_again(work_dir, remote_dir, url):
+    run_doit(work_dir, url)
+
+    # Last-Modified only has whole seconds, so move the change well past it
+    write_remote(remote_dir, 'Rainfall', 'Rainfall version 2\n')
+    later = time.time() + 10
+    os.utime(os.path.join(remote_dir, 'Rainfall', 'ranked', 'UK.txt'), (later, later))
+
+    output = run_doit(work_dir, url)
+    assert '.  download_data:Rainfall' in output, output
+    assert '-- download_data:Tmean' in output, output
+    with open(os.path.join(work_dir, 'UK_Rainfall_data.txt')) as f:
+        assert f.read() == 'Rainfall version 2\n'
+
+def test_first_run_downloads():
+    with_server(check_first_run_downloads)
+
+def test_unchanged_files_skipped():
+    with_server(check_unchanged_files_skipped)
+
+def test_changed_file_downloaded_again():
+    with_server(check_changed_file_downloaded_again)
+
+def run_tests():
+    test_first_run_downloads()
+    test_unchanged_files_skipped()
+    test_changed_file_downloaded_again()
+    print('all tests passed')
+
+if __name__ == '__main__':
+    run_tests()
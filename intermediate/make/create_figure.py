@@ -5,33 +5,124 @@ import pandas as pd
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
+import argparse
+import hashlib
+import io
+import json
+import os
 import sys
 import time
 
 """ Makes a bar plot based on summary data """
 
 
-# Command line arguments
-figure_name = sys.argv[1]
-summary_data = sys.argv[2]
+parser = argparse.ArgumentParser(description='Makes a bar plot based on summary data.')
+parser.add_argument('figure_name', help='Name of the figure file to write.')
+parser.add_argument('summary_data', help='Summary data file produced by stats.py.')
+parser.add_argument('--reproducible', action='store_true',
+                    help='Leave the date and time out of the title and the file '
+                         'metadata, so unchanged summaries give byte-identical figures.')
+parser.add_argument('--manifest', default=None,
+                    help='JSON file recording the content hash of each summary and '
+                         'figure. Figures whose summary is unchanged are not redrawn.')
 
-# Read in data
-tdata = pd.read_csv(summary_data)
+# Metadata keys that hold a timestamp for each output format. PostScript
+# has no way to leave its date out, so it is pinned with SOURCE_DATE_EPOCH.
+TIMESTAMP_METADATA = {
+    'svg': {'Date': None},
+    'pdf': {'CreationDate': None, 'ModDate': None},
+}
 
-# Set up values for bar plot
-species = tdata[tdata.columns[0]]
-x_pos = np.arange(len(species))
-value = tdata['mean']
-SE = tdata['std'] / np.sqrt(tdata['count'])
 
-# Make and save plot
-plt.bar(x_pos, value, yerr=SE, align='center', alpha=0.4)
-plt.xticks(x_pos, species)
-plt.ylabel('Value')
-plt.xlabel('Species')
-plt.title('Plot from %s on %s at %s' % (summary_data,
-                                        time.strftime("%m/%d/%Y"),
-                                        time.strftime("%H:%M:%S")))
-plt.savefig(figure_name)
+def file_hash(path):
+    """Return the sha256 hex digest of the contents of path, or None if it doesn't exist"""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
 
 
+def load_manifest(path):
+    """Read the manifest as a dict, returning an empty one if there isn't a file yet"""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(path, manifest):
+    """Write the manifest with sorted keys, so the same hashes always give the same file"""
+    text = json.dumps(manifest, indent=2, sort_keys=True) + '\n'
+    if os.path.exists(path):
+        with open(path) as f:
+            if f.read() == text:
+                return
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def make_figure(figure_name, summary_data, reproducible=False):
+    """Draw the bar plot and return the bytes of the saved figure"""
+
+    # Read in data
+    tdata = pd.read_csv(summary_data)
+
+    # Set up values for bar plot
+    species = tdata[tdata.columns[0]]
+    x_pos = np.arange(len(species))
+    value = tdata['mean']
+    SE = tdata['std'] / np.sqrt(tdata['count'])
+
+    # Make plot
+    plt.bar(x_pos, value, yerr=SE, align='center', alpha=0.4)
+    plt.xticks(x_pos, species)
+    plt.ylabel('Value')
+    plt.xlabel('Species')
+
+    fmt = os.path.splitext(figure_name)[1][1:].lower() or 'png'
+    if reproducible:
+        plt.title('Plot from %s' % summary_data)
+        # svg element ids are random unless they are salted with a fixed string
+        matplotlib.rcParams['svg.hashsalt'] = summary_data
+        # Every backend dates its output from this instead of the clock when it is set
+        os.environ['SOURCE_DATE_EPOCH'] = '0'
+        metadata = TIMESTAMP_METADATA.get(fmt)
+    else:
+        plt.title('Plot from %s on %s at %s' % (summary_data,
+                                                time.strftime("%m/%d/%Y"),
+                                                time.strftime("%H:%M:%S")))
+        metadata = None
+
+    buf = io.BytesIO()
+    plt.savefig(buf, format=fmt, metadata=metadata)
+    plt.close()
+    return buf.getvalue()
+
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+
+    manifest = {}
+    summary_hash = file_hash(args.summary_data)
+    if args.manifest is not None:
+        manifest = load_manifest(args.manifest)
+        entry = manifest.get(args.figure_name, {})
+
+        # Nothing to do if the summary hasn't changed and the figure is still the one we made
+        if (entry.get('summary') == summary_hash and
+                entry.get('figure') == file_hash(args.figure_name)):
+            sys.exit(0)
+
+    figure = make_figure(args.figure_name, args.summary_data,
+                         reproducible=args.reproducible)
+    figure_hash = hashlib.sha256(figure).hexdigest()
+
+    # Only touch the figure when its contents change, so its timestamp means something
+    if figure_hash != file_hash(args.figure_name):
+        with open(args.figure_name, 'wb') as f:
+            f.write(figure)
+
+    if args.manifest is not None:
+        manifest[args.figure_name] = {'summary': summary_hash, 'figure': figure_hash}
+        save_manifest(args.manifest, manifest)
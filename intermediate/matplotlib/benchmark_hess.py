@@ -0,0 +1,69 @@
+"""
+Times data_plots.SharedBinner against np.histogram2d for binning a
+Hess diagram, and np.histogram for a luminosity function. Starting the
+pool and copying the stars into shared memory is timed separately,
+since make_plots does that once for all its binning.
+
+The input is synthetic: a cloud of stars with normally distributed color
+and magnitude. 10^8 stars need 3.2 GB to hold: 1.6 GB for color and mag
+in float64, and as much again for SharedBinner's shared copy. Binning
+them with np.histogram2d, or across the workers, takes about 4 GB more
+while it runs, so the peak is over 7 GB. Use --stars to try something
+smaller first.
+
+    python benchmark_hess.py --stars 100000000 --processes 8
+"""
+
+import argparse
+import multiprocessing
+import timeit
+
+import numpy as np
+
+from data_plots import SharedBinner
+
+parser = argparse.ArgumentParser(description='Benchmark parallel Hess diagram binning on synthetic stars.')
+parser.add_argument('--stars', type=float, default=1e8, help='Number of synthetic stars.')
+parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(),
+                    help='Number of worker processes for SharedBinner.')
+parser.add_argument('--binsize', type=float, default=0.05, help='Magnitude bin width.')
+parser.add_argument('--cbinsize', type=float, default=0.1, help='Color bin width.')
+parser.add_argument('--repeat', type=int, default=3, help='Number of timings to take the best of.')
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(42)
+    nstars = int(args.stars)
+    color = rng.normal(1, 0.5, nstars)
+    mag = rng.normal(24, 1.5, nstars)
+
+    cbin = np.arange(color.min(), color.max(), args.cbinsize)
+    mbin = np.arange(mag.min(), mag.max(), args.binsize)
+
+    print('{0} stars, {1} x {2} bins, {3} processes'.format(
+        nstars, len(cbin) - 1, len(mbin) - 1, args.processes))
+
+    started = timeit.default_timer()
+    binner = SharedBinner((color, mag), args.processes)
+    print('{0:>18}: {1:.3f} s'.format('pool + sharing', timeit.default_timer() - started))
+
+    try:
+        # Check the two ways of binning agree on these stars before timing them
+        expected, _, _ = np.histogram2d(color, mag, bins=[cbin, mbin])
+        assert np.array_equal(expected, binner.counts((color, mag), (cbin, mbin)))
+        expected, _ = np.histogram(mag, bins=mbin)
+        assert np.array_equal(expected, binner.counts((mag,), (mbin,)))
+
+        timings = [
+            ('hess: histogram2d', lambda: np.histogram2d(color, mag, bins=[cbin, mbin])),
+            ('hess: parallel', lambda: binner.counts((color, mag), (cbin, mbin))),
+            ('lf: histogram', lambda: np.histogram(mag, bins=mbin)),
+            ('lf: parallel', lambda: binner.counts((mag,), (mbin,))),
+        ]
+        for name, func in timings:
+            best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+            print('{0:>18}: {1:.3f} s'.format(name, best))
+    finally:
+        binner.close()
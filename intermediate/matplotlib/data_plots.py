@@ -4,21 +4,52 @@ Script to make CMD, LF, or Hess diagram from a binary fits table
 Written by: Phil Rosenfield
 """
 import argparse
+import hashlib
+import json
 from astropy.io import fits
 import matplotlib.pylab as plt
+import multiprocessing
 import numpy as np
+import os
 import sys
 
-def plot_cmd(color, mag, color_err=None, mag_err=None, ax=None):
+# stars with |color| or |mag| at least this big were not recovered
+QUALITY_CUT = 30
+
+PLOT_TYPES = ['cmd', 'hess', 'lf']
+
+
+def plot_cmd(color, mag, color_err=None, mag_err=None, ax=None,
+             max_points=100000, density_bins=200, outlier_count=5,
+             error_bins=20):
     '''
     Plot a Color Magnitude diagram with uncertainties
-    
+
+    Above max_points stars, the CMD is drawn as a rasterized image of star
+    counts, and only stars in bins with fewer than outlier_count stars are
+    drawn as points. The uncertainties are then summarized as the mean
+    color and mag errors in error_bins magnitude bins, drawn down the right
+    hand side of the plot, instead of an error bar on every star.
+
     Parameters
     ----------
     color, mag : color and magnitude arrays
     color_err, mag_err: uncertainties in color and mag
     
     ax : axes instance
+
+    max_points : int or None
+        number of stars above which to plot the density instead,
+        None to always plot every star
+
+    density_bins : int
+        number of color and of magnitude bins in the density image
+
+    outlier_count : int
+        stars in density bins with fewer stars than this are plotted as points
+
+    error_bins : int
+        number of magnitude bins to average the uncertainties in
     
     Returns
     -------
@@ -28,18 +59,89 @@ def plot_cmd(color, mag, color_err=None, mag_err=None, ax=None):
     if ax is None:
         fig, ax = plt.subplots(figsize=(8, 8))
 
-    ax.plot(color, mag, '.', ms=3)
+    if max_points is None or len(color) <= max_points:
+        ax.plot(color, mag, '.', ms=3)
 
-    if color_err is not None and mag_err is not None:
-        ax.errorbar(color, mag, fmt='none', lw=1, xerr=color_err,
-                    yerr=mag_err, capsize=0, ecolor='gray')
+        if color_err is not None and mag_err is not None:
+            ax.errorbar(color, mag, fmt='none', lw=1, xerr=color_err,
+                        yerr=mag_err, capsize=0, ecolor='gray')
+
+        # reverse yaxis
+        ax.set_ylim(ax.get_ylim()[::-1])
+        return ax
+
+    from matplotlib.colors import LogNorm
+    cbin = np.linspace(color.min(), color.max(), density_bins + 1)
+    mbin = np.linspace(mag.min(), mag.max(), density_bins + 1)
+    counts = grid_counts((color, mag), (cbin, mbin))
+
+    # only the dense bins go in the image, the rest are drawn as stars
+    image = np.ma.masked_less(counts, outlier_count)
+    extent = [cbin[0], cbin[-1], mbin[-1], mbin[0]]
+    ax.imshow(image.T, norm=LogNorm(), cmap=plt.cm.gray_r, extent=extent,
+              interpolation='nearest', aspect='auto', rasterized=True)
 
-    # reverse yaxis
-    ax.set_ylim(ax.get_ylim()[::-1])
+    cidx = grid_indices(color, cbin)
+    midx = grid_indices(mag, mbin)
+    sparse = (cidx < 0) | (midx < 0) | (counts[cidx, midx] < outlier_count)
+    ax.plot(color[sparse], mag[sparse], '.', ms=3, rasterized=True)
+
+    if color_err is not None and mag_err is not None:
+        ebin = np.linspace(mag.min(), mag.max(), error_bins + 1)
+        eidx = grid_indices(mag, ebin)
+        inbin = eidx >= 0
+        nstars = np.bincount(eidx[inbin], minlength=error_bins)
+        filled = nstars > 0
+        mean_cerr = np.bincount(eidx[inbin], weights=color_err[inbin],
+                                minlength=error_bins)[filled] / nstars[filled]
+        mean_merr = np.bincount(eidx[inbin], weights=mag_err[inbin],
+                                minlength=error_bins)[filled] / nstars[filled]
+        centers = (0.5 * (ebin[1:] + ebin[:-1]))[filled]
+        xpos = np.repeat(cbin[-1] - 0.05 * (cbin[-1] - cbin[0]), len(centers))
+        ax.errorbar(xpos, centers, fmt='none', lw=1, xerr=mean_cerr,
+                    yerr=mean_merr, capsize=0, ecolor='gray')
+
+    # imshow's extent already runs mag down the yaxis
+    ax.set_xlim(cbin[0], cbin[-1])
+    ax.set_ylim(mbin[-1], mbin[0])
     return ax
 
 
-def plot_lf(mag, binsize, mbin=None, yscale='log'):
+def make_lf(mag, binsize, mbin=None, processes=None, binner=None):
+    """
+    Compute a Luminosity function (binned magnitudes)
+
+    Parameters
+    ----------
+    mag : array
+        magnitude array to be binned
+    binsize : float
+        width of magnitude bins
+    mbin : array
+        right edges of magnitude bins
+    processes : int or None
+        if given, bin on that many processes with parallel_counts
+    binner : SharedBinner or None
+        if given, bin with its pool; mag must be one of its arrays
+
+    Returns
+    -------
+    lf : array
+        number of stars in each bin
+    bins : array
+        the magnitude bin edges
+    """
+    if mbin is None:
+        mbin = np.arange(mag.min(), mag.max(), binsize)
+
+    if binner is not None:
+        return binner.counts((mag,), (mbin,)), mbin
+    if processes is not None:
+        return parallel_counts((mag,), (mbin,), processes=processes), mbin
+    return np.histogram(mag, bins=mbin)
+
+
+def plot_lf(mag, binsize, mbin=None, yscale='log', processes=None, binned=None):
     """
     Make a Luminosty function (binned magnitude) plot
     
@@ -53,22 +155,27 @@ def plot_lf(mag, binsize, mbin=None, yscale='log'):
         right edges of magnitude bins
     yscale : str
         plt.set_yscale option
+    processes : int or None
+        passed to make_lf
+    binned : tuple or None
+        (lf, bins) already computed by make_lf, in which case mag is not used
 
     Returns
     -------
     ax : axes instance
     """
-    if mbin is None:
-        mbin = np.arange(mag.min(), mag.max(), binsize)
-    
-    lf, bins = np.histogram(mag, bins=mbin)
+    if binned is None:
+        binned = make_lf(mag, binsize, mbin=mbin, processes=processes)
+    lf, bins = binned
+
     fig, ax = plt.subplots()
     
-    ax.plot(bins[1:], lf, linestyle='steps-pre')
+    ax.plot(bins[1:], lf, drawstyle='steps-pre')
     ax.set_yscale(yscale)
     return ax
     
-def make_hess(color, mag, binsize, cbinsize=None, mbin=None, cbin=None):
+def make_hess(color, mag, binsize, cbinsize=None, mbin=None, cbin=None,
+              processes=None, binner=None):
     """
     Compute a hess diagram (surface-density CMD) on photometry data.
 
@@ -89,6 +196,14 @@ def make_hess(color, mag, binsize, cbinsize=None, mbin=None, cbin=None):
     mbin : array
         the right edges of the magnitude bins
 
+    processes : int or None
+        if given, bin on that many processes with parallel_counts
+        (the bins must then be evenly spaced)
+
+    binner : SharedBinner or None
+        if given, bin with its pool instead; color and mag must be among its
+        arrays, and the bins evenly spaced
+
     Returns
     -------
     cbin : array
@@ -109,12 +224,304 @@ def make_hess(color, mag, binsize, cbinsize=None, mbin=None, cbin=None):
             cbinsize = binsize
         cbin = np.arange(color.min(), color.max(), cbinsize)
 
-    hess, cbin, mbin = np.histogram2d(color, mag, bins=[cbin, mbin])
+    if binner is not None:
+        hess = binner.counts((color, mag), (cbin, mbin))
+    elif processes is not None:
+        hess = parallel_counts((color, mag), (cbin, mbin), processes=processes)
+    else:
+        hess, cbin, mbin = np.histogram2d(color, mag, bins=[cbin, mbin])
+    return hess, cbin, mbin
+
+
+def grid_indices(values, edges):
+    """
+    Find the bin of each value on a grid of evenly spaced bin edges from
+    its distance to the first edge, instead of searching the edges.
+
+    Parameters
+    ----------
+    values : array
+        values to be binned
+
+    edges : array
+        evenly spaced bin edges, as made by np.arange
+
+    Returns
+    -------
+    index : int array
+        the bin of each value, or -1 for values outside the edges (or NaN).
+        Like np.histogram, the last bin includes its right edge, and a value
+        on any other edge goes in the bin to its right.
+    """
+    nbins = len(edges) - 1
+    # comparisons with NaN are False, so NaNs are left out here too
+    inside = (values >= edges[0]) & (values <= edges[-1])
+    index = np.floor((values - edges[0]) / (edges[1] - edges[0]))
+    index = np.where(inside, np.clip(index, 0, nbins - 1), 0).astype(np.intp)
+
+    # Rounding can put a value that sits on an edge one bin out, so check
+    # the index against the edges themselves, the way np.histogram does
+    index[values < edges[index]] -= 1
+    index[(values >= edges[index + 1]) & (index < nbins - 1)] += 1
+    index[~inside] = -1
+    return index
+
+
+def grid_counts(values, edges):
+    """
+    Count points on a grid of evenly spaced bins in any number of dimensions,
+    with one bincount over a flattened bin index.
+
+    Parameters
+    ----------
+    values : sequence of arrays
+        one array of coordinates per dimension, e.g. (color, mag)
+
+    edges : sequence of arrays
+        evenly spaced bin edges for each dimension
+
+    Returns
+    -------
+    counts : int array
+        number of points in each bin, shaped (len(edges[0]) - 1, ...)
+    """
+    shape = tuple(len(e) - 1 for e in edges)
+    flat = np.zeros(len(values[0]), dtype=np.intp)
+    inside = np.ones(len(values[0]), dtype=bool)
+    for vals, e, nbins in zip(values, edges, shape):
+        index = grid_indices(vals, e)
+        inside &= index >= 0
+        flat = flat * nbins + index
+    counts = np.bincount(flat[inside], minlength=int(np.prod(shape)))
+    return counts.astype(np.int64).reshape(shape)
+
+
+def accumulate_hess(chunks, cbin, mbin):
+    """
+    Compute a hess diagram from chunks of photometry, without needing all of
+    it in memory at once.
+
+    Parameters
+    ----------
+    chunks : iterable
+        (color, mag) array pairs, e.g. from iter_chunks
+
+    cbin, mbin : array, array
+        evenly spaced edges of the color and magnitude bins
+
+    Returns
+    -------
+    hess : 2d int array
+        The Hess diagram counts, indexed [color bin, mag bin] like make_hess
+    """
+    hess = np.zeros((len(cbin) - 1, len(mbin) - 1), dtype=np.int64)
+    for color, mag in chunks:
+        hess += grid_counts((color, mag), (cbin, mbin))
+    return hess
+
+
+# Views of the shared input arrays, set in each worker by _init_binning
+_shared_values = None
+
+# RawArray typecodes for the dtypes that can be shared as they are
+SHARED_TYPECODES = {np.dtype(np.float32): 'f', np.dtype(np.float64): 'd'}
+
+
+def _share(values):
+    """
+    Copy an array into shared memory that pool workers can read without
+    pickling. float32 stays float32, anything else becomes float64.
+    Returns the RawArray and the dtype to view it with.
+    """
+    typecode = SHARED_TYPECODES.get(np.dtype(values.dtype.type), 'd')
+    dtype = np.dtype(typecode)
+    shared = multiprocessing.RawArray(typecode, len(values))
+    np.frombuffer(shared, dtype=dtype)[:] = values
+    return shared, dtype
+
+
+def _init_binning(shared):
+    global _shared_values
+    _shared_values = [np.frombuffer(s, dtype=dtype) for s, dtype in shared]
+
+
+def _bin_rows(job):
+    """Count rows start:stop of some of the shared arrays; runs in a pool worker"""
+    which, start, stop, edges = job
+    return grid_counts([_shared_values[i][start:stop] for i in which], edges)
+
+
+class SharedBinner(object):
+    """
+    A pool of worker processes that share a set of arrays, so they can be
+    binned many times (e.g. a Hess diagram and an LF) with one copy of the
+    arrays and one pool.
+
+    Parameters
+    ----------
+    arrays : sequence of arrays
+        the arrays to share, all of the same length
+
+    processes : int or None
+        number of worker processes, defaults to the number of CPUs
+    """
+
+    def __init__(self, arrays, processes=None):
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.arrays = list(arrays)
+        self.processes = processes
+        shared = [_share(array) for array in self.arrays]
+        self.pool = multiprocessing.Pool(processes, initializer=_init_binning,
+                                         initargs=(shared,))
+
+    def counts(self, values, edges):
+        """
+        grid_counts split over the pool: each worker counts a contiguous
+        block of rows, and the per-worker counts are summed.
+
+        Parameters
+        ----------
+        values : sequence of arrays
+            arrays passed to the constructor (the same objects)
+
+        edges : sequence of arrays
+            as grid_counts
+        """
+        which = [[i for i, array in enumerate(self.arrays) if array is vals][0]
+                 for vals in values]
+        nrows = len(values[0])
+        step = max(1, -(-nrows // self.processes))
+        jobs = [(which, start, min(start + step, nrows), edges)
+                for start in range(0, nrows, step)]
+
+        counts = np.zeros(tuple(len(e) - 1 for e in edges), dtype=np.int64)
+        for part in self.pool.imap_unordered(_bin_rows, jobs):
+            counts += part
+        return counts
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def parallel_counts(values, edges, processes=None):
+    """
+    grid_counts split over a pool of processes, for a single binning.
+    To bin the same arrays more than once, use a SharedBinner.
+
+    Parameters
+    ----------
+    values, edges : as grid_counts
+
+    processes : int or None
+        number of worker processes, defaults to the number of CPUs
+
+    Returns
+    -------
+    counts : int array
+        as grid_counts
+    """
+    binner = SharedBinner(values, processes)
+    try:
+        return binner.counts(values, edges)
+    finally:
+        binner.close()
+
+
+def iter_chunks(hdu, yfilt='I', chunksize=1000000, errors=False):
+    """
+    Yield (color, mag) for chunksize rows of an open fits table at a time,
+    keeping only stars that pass good_stars. With a memory-mapped file only
+    one chunk of the table is read at a time.
+
+    Parameters
+    ----------
+    hdu : HDUList
+        binary fits table opened with astropy.io.fits
+
+    yfilt : string
+        filter to use as mag (V or I)
+
+    chunksize : int
+        number of rows per chunk
+
+    errors : bool
+        yield (color, mag, color_err, mag_err) instead, as load_data
+    """
+    data = hdu[1].data
+    photsys = hdu[0].header['CAMERA']
+    if yfilt.upper() == 'I':
+        ymag = 'MAG2'
+    else:
+        ymag = 'MAG1'
+
+    for start in range(0, len(data), chunksize):
+        rows = data[start:start + chunksize]
+        color = np.subtract(rows['MAG1_%s' % photsys], rows['MAG2_%s' % photsys])
+        mag = rows['%s_%s' % (ymag, photsys)]
+        good = good_stars(color, mag)
+        if not errors:
+            yield color[good], mag[good]
+            continue
+
+        color_err = np.hypot(rows['MAG1_ERR'][good], rows['MAG2_ERR'][good])
+        yield color[good], mag[good], color_err, rows['%s_ERR' % ymag][good]
+
+
+def stream_hess(fitsfile, binsize, cbinsize=None, yfilt='I', chunksize=1000000,
+                mbin=None, cbin=None):
+    """
+    Compute a hess diagram straight from a binary fits table, reading it
+    chunksize rows at a time. The counts are the same as make_hess on the
+    good stars of the whole table, but memory use depends on chunksize and
+    the number of bins rather than the size of the catalog.
+
+    Parameters
+    ----------
+    fitsfile : string or file object
+        path to binary fits table or object to be read by astropy.io.fits
+
+    binsize, cbinsize : float, float
+        width of mag, color bins in magnitudes
+
+    yfilt : string
+        filter to use as mag (V or I)
+
+    chunksize : int
+        number of table rows to bin at a time
+
+    mbin, cbin : array, array
+        evenly spaced magnitude and color bin edges. If either is not given,
+        the table is read through once first to find the data limits.
+
+    Returns
+    -------
+    hess, cbin, mbin : as make_hess
+    """
+    hdu = fits.open(fitsfile, memmap=True)
+    try:
+        if mbin is None or cbin is None:
+            limits = np.array([[color.min(), color.max(), mag.min(), mag.max()]
+                               for color, mag in iter_chunks(hdu, yfilt, chunksize)
+                               if len(mag)])
+            if mbin is None:
+                mbin = np.arange(limits[:, 2].min(), limits[:, 3].max(), binsize)
+            if cbin is None:
+                if cbinsize is None:
+                    cbinsize = binsize
+                cbin = np.arange(limits[:, 0].min(), limits[:, 1].max(), cbinsize)
+
+        hess = accumulate_hess(iter_chunks(hdu, yfilt, chunksize), cbin, mbin)
+    finally:
+        hdu.close()
+
     return hess, cbin, mbin
 
 
 def plot_hess(color, mag, binsize, ax=None, colorbar=False,
-              vmin=None, vmax=None, cbinsize=None, im_kwargs={}):
+              vmin=None, vmax=None, cbinsize=None, im_kwargs={}, binned=None,
+              processes=None):
     """
     Plot a hess diagram with imshow.
     
@@ -141,6 +548,13 @@ def plot_hess(color, mag, binsize, ax=None, colorbar=False,
                     'interpolation': 'nearest',
                     'extent' [limits of mag and color]
                     'aspect': 'auto'}
+
+    binned : tuple or None
+        (hess, cbin, mbin) already computed by make_hess or stream_hess,
+        in which case color and mag are not used
+
+    processes : int or None
+        passed to make_hess
     Returns
     -------
     ax : axes instance
@@ -149,7 +563,10 @@ def plot_hess(color, mag, binsize, ax=None, colorbar=False,
     if ax is None:
         fig, ax = plt.subplots()
 
-    hess, cbin, mbin = make_hess(color, mag, binsize, cbinsize=cbinsize)
+    if binned is None:
+        binned = make_hess(color, mag, binsize, cbinsize=cbinsize,
+                           processes=processes)
+    hess, cbin, mbin = binned
     extent = [np.min(cbin), np.max(cbin), np.max(mbin), np.min(mbin)]
     vmax = vmax or hess.max()
 
@@ -159,7 +576,7 @@ def plot_hess(color, mag, binsize, ax=None, colorbar=False,
                 'extent': extent,
                 'aspect': 'auto'}
 
-    kwargs = dict(defaults.items() + im_kwargs.items())
+    kwargs = dict(defaults, **im_kwargs)
 
     im = ax.imshow(hess.T, **kwargs)
 
@@ -169,7 +586,7 @@ def plot_hess(color, mag, binsize, ax=None, colorbar=False,
     return ax
 
 
-def load_data(fitsfile, yfilt='I'):
+def load_data(fitsfile, yfilt='I', memmap=None):
     """
     Load color, magnitude and uncertainties from binary fits table
     
@@ -181,22 +598,28 @@ def load_data(fitsfile, yfilt='I'):
     yfilt : string
         filter to use as mag (V or I)
 
+    memmap : bool or None
+        passed to astropy.io.fits.open. None keeps astropy's default, which
+        memory-maps the table, so mag and mag_err are views of the file and
+        only color and color_err are new arrays.
+
     Returns
     -------
     color, mag : arrays of color and magnitude
     color_error, mag_err : arrays of summed quadriture uncertainies and magnitude uncertainties
     """
 
-    hdu = fits.open(fitsfile)
+    hdu = fits.open(fitsfile, memmap=memmap)
     data = hdu[1].data
     photsys = hdu[0].header['CAMERA']
 
     # the magnitude fields in the fits file are named MAG{1,2}_[photsys]
     mag1 = data['MAG1_%s' % photsys]
     mag2 = data['MAG2_%s' % photsys]
-    color = mag1 - mag2
 
-    color_err = np.sqrt(data['MAG1_ERR'] ** 2 + data['MAG2_ERR'] ** 2)
+    # no temporaries: hypot is sqrt(a**2 + b**2) in one pass
+    color = np.subtract(mag1, mag2)
+    color_err = np.hypot(data['MAG1_ERR'], data['MAG2_ERR'])
 
     # choose what gets the yaxis V or I
     if yfilt.upper() == 'I':
@@ -211,12 +634,267 @@ def load_data(fitsfile, yfilt='I'):
 
     return color, mag, color_err, mag_err
 
-    
+
+def good_stars(color, mag):
+    """
+    Boolean mask of stars recovered in both filters.
+
+    The fits file contains stars that are recovered in only one filter;
+    stars not recovered are given values >= 90. No need to plot em.
+    """
+    good = np.abs(color) < QUALITY_CUT
+    good &= np.abs(mag) < QUALITY_CUT
+    return good
+
+
+def load_good_data(fitsfile, yfilt='I', chunksize=1000000, memmap=None):
+    """
+    Load color, magnitude and uncertainties of the stars that pass
+    good_stars, as load_data.
+
+    The table is read chunksize rows at a time, once to count the good
+    stars and once to copy them into arrays of exactly that size, so
+    apart from those arrays only one chunk is in memory at a time.
+
+    Parameters
+    ----------
+    fitsfile : string or file object
+        path to binary fits table or object to be read by astropy.io.fits
+
+    yfilt : string
+        filter to use as mag (V or I)
+
+    chunksize : int
+        number of table rows to read at a time
+
+    memmap : bool or None
+        passed to astropy.io.fits.open, see load_data
+
+    Returns
+    -------
+    color, mag, color_err, mag_err : as load_data, for the good stars only
+    """
+    hdu = fits.open(fitsfile, memmap=memmap)
+    try:
+        ngood = sum(len(mag) for _, mag in iter_chunks(hdu, yfilt, chunksize))
+
+        arrays = None
+        filled = 0
+        for chunk in iter_chunks(hdu, yfilt, chunksize, errors=True):
+            if arrays is None:
+                # native byte order, fits columns are big-endian
+                arrays = [np.empty(ngood, dtype=column.dtype.type) for column in chunk]
+            nrows = len(chunk[0])
+            for array, column in zip(arrays, chunk):
+                array[filled:filled + nrows] = column
+            filled += nrows
+    finally:
+        hdu.close()
+
+    if arrays is None:
+        return [np.empty(0) for _ in range(4)]
+    return arrays
+
+
+def file_hash(path):
+    """Return the sha256 hex digest of the contents of path, read a block at a time"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_file(fitsfile, kind):
+    """The .npz file next to fitsfile that caches its binned products of one kind"""
+    return '%s.%s.npz' % (os.path.splitext(fitsfile)[0], kind)
+
+
+def cache_key(digest, yfilt, binsize, cbinsize=None):
+    """
+    Everything the binned products depend on: the contents of the fits
+    file (its file_hash digest), the filter on the mag axis, the bin sizes
+    and the quality cut.
+    """
+    return json.dumps({'hash': digest,
+                       'yfilt': yfilt.upper(),
+                       'binsize': binsize,
+                       'cbinsize': cbinsize,
+                       'quality_cut': QUALITY_CUT}, sort_keys=True)
+
+
+def load_binned(fitsfile, kind, key):
+    """
+    Return the arrays cached for fitsfile by save_binned, or None if
+    there aren't any or they were made with a different key.
+    """
+    path = cache_file(fitsfile, kind)
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path) as cached:
+            if str(cached['key']) != key:
+                return None
+            return tuple(cached['arr_%i' % i] for i in range(len(cached.files) - 1))
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+
+
+def save_binned(fitsfile, kind, key, binned):
+    """Save binned arrays, e.g. (hess, cbin, mbin), next to fitsfile with their key"""
+    np.savez(cache_file(fitsfile, kind), *binned, key=key)
+
+
+def output_name(outfile, fitsfile, plottype, batch=False):
+    """
+    Name of the file to save a plot in. A single plot is saved as outfile;
+    in batch mode each plot is saved next to outfile as
+    [fits file name]_[plottype], with outfile's extension.
+    """
+    if not batch:
+        return outfile
+    base = os.path.splitext(os.path.basename(fitsfile))[0]
+    ext = os.path.splitext(outfile)[1]
+    return os.path.join(os.path.dirname(outfile), '%s_%s%s' % (base, plottype, ext))
+
+
+def make_plots(fitsfile, plottypes, args, batch=False):
+    """
+    Load a fits file once and save one plot for each of plottypes,
+    all made from the same good stars.
+
+    Parameters
+    ----------
+    fitsfile : string
+        path to binary fits table
+
+    plottypes : list
+        any of 'cmd', 'hess', 'lf'
+
+    args : argparse.Namespace
+        the plot options parsed by main
+
+    batch : bool
+        name the outputs after fitsfile and plottype, see output_name
+
+    Returns
+    -------
+    outfiles : list of the files written
+    """
+    # set the plot style (again, in case this is a new worker process)
+    plt.style.use(args.style)
+
+    if args.filters is not None:
+        filter1, filter2 = args.filters.split(',')
+    else:
+        filter1 = 'V'
+        filter2 = 'I'
+
+    yfilt = args.yfilter
+
+    # reuse the hess diagram and LF saved by an earlier run if asked
+    binned = {}
+    keys = {}
+    if args.cache and ('hess' in plottypes or 'lf' in plottypes):
+        # hashing reads the whole catalog, so only do it once
+        digest = file_hash(fitsfile)
+        keys = {'hess': cache_key(digest, yfilt, args.binsize, args.cbinsize),
+                'lf': cache_key(digest, yfilt, args.binsize)}
+        for kind in ('hess', 'lf'):
+            if kind in plottypes:
+                cached = load_binned(fitsfile, kind, keys[kind])
+                if cached is not None:
+                    binned[kind] = cached
+
+    # bin the table a chunk at a time instead of loading it, if that's all we need
+    stream = args.chunksize is not None
+    if 'hess' in plottypes and 'hess' not in binned and stream:
+        binned['hess'] = stream_hess(fitsfile, args.binsize, cbinsize=args.cbinsize,
+                                     yfilt=yfilt, chunksize=args.chunksize)
+        if args.cache:
+            save_binned(fitsfile, 'hess', keys['hess'], binned['hess'])
+
+    if any(plottype not in binned for plottype in plottypes):
+        color, mag, color_err, mag_err = load_good_data(
+            fitsfile, yfilt=yfilt, chunksize=args.chunksize or 1000000,
+            memmap=args.memmap)
+
+        # share color and mag with one pool for all the binning
+        binner = None
+        if args.processes is not None and any(kind in plottypes and kind not in binned
+                                              for kind in ('hess', 'lf')):
+            binner = SharedBinner((color, mag), args.processes)
+
+        try:
+            if 'hess' in plottypes and 'hess' not in binned:
+                binned['hess'] = make_hess(color, mag, args.binsize, cbinsize=args.cbinsize,
+                                           binner=binner)
+                if args.cache:
+                    save_binned(fitsfile, 'hess', keys['hess'], binned['hess'])
+
+            if 'lf' in plottypes and 'lf' not in binned:
+                binned['lf'] = make_lf(mag, args.binsize, binner=binner)
+                if args.cache:
+                    save_binned(fitsfile, 'lf', keys['lf'], binned['lf'])
+        finally:
+            if binner is not None:
+                binner.close()
+
+    outfiles = []
+    for plottype in plottypes:
+        if plottype == 'cmd':
+            ax = plot_cmd(color, mag, color_err=color_err, mag_err=mag_err,
+                          max_points=args.maxpoints)
+
+        if plottype == 'hess':
+            ax = plot_hess(None, None, colorbar=args.colorbar,
+                           binsize=args.binsize, binned=binned['hess'])
+
+        if plottype == 'lf':
+            ax = plot_lf(None, args.binsize, yscale=args.yscale,
+                         binned=binned['lf'])
+
+            # make axis labels
+            ax.set_xlabel(r'$%s$' % yfilt)
+            ax.set_ylabel(r'$\#$')
+        else:
+            # make axis labels for cmd, hess
+            ylabel = yfilt
+            if args.filters is not None:
+                if yfilt == 'I':
+                    ylabel = filter2
+                else:
+                    ylabel = filter1
+
+            ax.set_ylabel(r'$%s$' % ylabel)
+            ax.set_xlabel(r'$%s-%s$' % (filter1, filter2))
+
+        if args.ylim is not None:
+            ylim = np.array(''.join(args.ylim).split(','), dtype=float)
+            ax.set_ylim(ylim)
+
+        if args.xlim is not None:
+            xlim = np.array(''.join(args.xlim).split(','), dtype=float)
+            ax.set_xlim(xlim)
+
+        outfile = output_name(args.outfile, fitsfile, plottype, batch=batch)
+        ax.figure.savefig(outfile)
+        plt.close(ax.figure)
+        outfiles.append(outfile)
+
+    return outfiles
+
+
+def _make_plots(job):
+    """make_plots for one (fitsfile, plottypes, args, batch) job from main"""
+    return make_plots(*job)
+
+
 def main(argv):
-    parser = argparse.ArgumentParser(description="Generate a plot of a fits file")
+    parser = argparse.ArgumentParser(description="Generate plots of one or more fits files")
 
     parser.add_argument('-p', '--plottype', type=str, default='cmd',
-                        help='which plot to make: CMD, hess, or LF')
+                        help='which plot to make: CMD, hess, or LF, or several separated by commas')
 
     parser.add_argument('-f', '--filters', type=str, default=None,
                         help='comma separated V and I filter names for plot labels')
@@ -243,68 +921,71 @@ def main(argv):
                         help='add the hess diagram colorbar')
 
     parser.add_argument('-outfile', '--outfile', type=str, default='data_plot.png',
-                        help='the name of the output file')
+                        help='the name of the output file. With several files or plot types, '
+                             'each plot is saved in the same directory as '
+                             '[fits file name]_[plottype] with the same extension')
 
     parser.add_argument('-style', '--style', type=str, default='ggplot',
                         choices=plt.style.available,
                         help='the name of the matplotlib style')
 
-    parser.add_argument('file', type=argparse.FileType('r'),
-                        help='the name of the fits file')
+    parser.add_argument('-no-memmap', '--no-memmap', dest='memmap', action='store_const',
+                        const=False, default=None,
+                        help='read the whole fits table into memory instead of memory-mapping it')
+
+    parser.add_argument('-chunksize', '--chunksize', type=int, default=None,
+                        help='read this many rows of the fits table at a time, and make the '
+                             'hess diagram as they are read instead of from the loaded stars')
+
+    parser.add_argument('-maxpoints', '--maxpoints', type=int, default=100000,
+                        help='plot the cmd as a density image above this many stars')
+
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help='bin the hess diagram or LF on this many processes')
+
+    parser.add_argument('-cache', '--cache', action='store_true',
+                        help='save the hess diagram and LF as .npz files next to the fits file '
+                             'and reuse them while the file and binning are unchanged')
+
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='plot this many fits files at once')
+
+    parser.add_argument('file', nargs='+',
+                        help='the name of the fits file(s)')
 
     args = parser.parse_args(argv)
 
-    # set the plot style
-    plt.style.use(args.style)
+    plottypes = [p.strip().lower() for p in args.plottype.split(',')]
+    for plottype in plottypes:
+        if plottype not in PLOT_TYPES:
+            parser.error('unknown plot type %s, choose from %s'
+                         % (plottype, ', '.join(PLOT_TYPES)))
 
-    if args.filters is not None:
-        filter1, filter2 = args.filters.split(',')
-    else:
-        print('warning: using V, I as default filter names')
-        filter1 = 'V'
-        filter2 = 'I'
-    
-    yfilt = args.yfilter
-    
-    color, mag, color_err, mag_err = load_data(args.file, yfilt=yfilt)
-    # the fits file contains stars that are recovered in only one filter
-    # stars not recovered are given values >= 90. No need to plot em.
-    good, = np.nonzero((np.abs(color) < 30) & (np.abs(mag) < 30))    
-    
-    if args.plottype.lower() == 'cmd':    
-        ax = plot_cmd(color[good], mag[good], color_err=color_err[good], mag_err=mag_err[good])
+    if args.workers > 1 and args.processes is not None:
+        # pool workers can't start pools of their own
+        parser.error('use only one of --workers and --processes')
 
-    if args.plottype.lower() == 'hess':
-        ax = plot_hess(color[good], mag[good], colorbar=args.colorbar,
-                       binsize=args.binsize, cbinsize=args.cbinsize)
+    if args.filters is None:
+        print('warning: using V, I as default filter names')
 
-    if args.plottype.lower() == 'lf':
-        ax = plot_lf(mag[good], args.binsize, yscale=args.yscale)
+    batch = len(args.file) > 1 or len(plottypes) > 1
+    jobs = [(fitsfile, plottypes, args, batch) for fitsfile in args.file]
 
-        # make axis labels
-        ax.set_xlabel(r'$%s$' % yfilt)
-        ax.set_ylabel(r'$\#$')
+    if args.workers > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(args.workers)
+        results = pool.imap(_make_plots, jobs)
     else:
-        # make axis labels for cmd, hess
-        if args.filters is not None:
-            if yfilt == 'I':
-                yfilt = filter2
-            else:
-                yfilt = filter1
-
-        ax.set_ylabel(r'$%s$' % yfilt)
-        ax.set_xlabel(r'$%s-%s$' % (filter1, filter2))
-
-    if args.ylim is not None:
-        ylim = np.array(''.join(args.ylim).split(','), dtype=float)
-        ax.set_ylim(ylim)
-    
-    if args.xlim is not None:
-        xlim = np.array(''.join(args.xlim).split(','), dtype=float)
-        ax.set_xlim(xlim)
-
-    plt.savefig(args.outfile)
-    print('wrote %s' % args.outfile)
+        pool = None
+        results = (_make_plots(job) for job in jobs)
+
+    try:
+        for outfiles in results:
+            for outfile in outfiles:
+                print('wrote %s' % outfile)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
 if __name__ == "__main__":
-    main(sys.argv[1:])
\ No newline at end of file
+    main(sys.argv[1:])
@@ -1,6 +1,9 @@
-import requests
 import cStringIO
 import csv
+from webcache import ResponseCache
+
+# Keep responses on disk so repeated runs don't download the same data again
+cache = ResponseCache()
 
 def get_country_temperatures(country):
     '''
@@ -10,8 +13,7 @@ def get_country_temperatures(country):
 
     base_url = 'http://climatedataapi.worldbank.org/climateweb/rest/v1/country/cru/tas/year/{0}.csv'
     actual_url = base_url.format(country)
-    response = requests.get(actual_url)
-    reader = cStringIO.StringIO(response.text)
+    reader = cStringIO.StringIO(cache.get(actual_url))
     wrapper = csv.reader(reader)
     result = []
     for record in wrapper:
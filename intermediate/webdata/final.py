@@ -1,18 +1,62 @@
 import requests
-import cStringIO
+import array
 import csv
+import numpy as np
+from multiprocessing.pool import ThreadPool
+from webcache import ResponseCache
+
+BASE_URL = 'http://climatedataapi.worldbank.org/climateweb/rest/v1/country/cru/tas/year/{0}.csv'
+
+# How many countries get_many_country_temperatures fetches at once.
+# requests keeps up to 10 connections per host open by default.
+MAX_THREADS = 8
+
+# Share one session between requests, so the connection to the
+# server is kept open and reused instead of made again every time
+session = requests.Session()
+
+# Historical climate data hardly ever changes, so keep responses on disk.
+# Set cache.offline = True to work only from what has been saved.
+cache = ResponseCache(session=session)
 
 def compare_countries(left_country, right_country):
     '''
     Compare average surface temperatures for two countries over time.
+    Result is [ [year, left - right], ... ] for the years both countries have data for.
+    '''
+    all_data = get_many_country_temperatures([left_country, right_country], arrays=True)
+    years, table = align_years([all_data[left_country], all_data[right_country]])
+
+    # Only keep years where neither country is missing
+    both = ~np.isnan(table).any(axis=0)
+    difference = table[0, both] - table[1, both]
+    return [[year, value] for (year, value) in zip(years[both].tolist(), difference.tolist())]
+
+def compare_many_countries(countries):
+    '''
+    Compare average surface temperatures between every pair of countries.
+    Result is (years, differences), where differences[i, j] is the series
+    of country i minus country j over those years, with NaN for years
+    that either country is missing.
+    '''
+    countries = list(countries)
+    all_data = get_many_country_temperatures(countries, arrays=True)
+    years, table = align_years([all_data[country] for country in countries])
+    return years, table[:, np.newaxis, :] - table[np.newaxis, :, :]
+
+def align_years(series):
+    '''
+    Line up several (years, values) series on the same years.
+    Result is (years, table): every year found in any series, and a
+    2-D array with one row per series and NaN where a series has no value.
     '''
-    left_data = get_country_temperatures(left_country)
-    right_data = get_country_temperatures(right_country)
-    result = []
-    for ( (left_year, left_value), (right_year, right_value) ) in zip(left_country, right_country):
-        assert left_year == right_year, 'Year mismatch: {0} vs {1}'.format(left_year, right_year)
-        result.append([left_year, left_value - right_value])
-    return result
+    years = np.unique(np.concatenate([np.asarray(y, dtype=int) for (y, _) in series]))
+    table = np.empty((len(series), len(years)))
+    table.fill(np.nan)
+    for row, (series_years, series_values) in enumerate(series):
+        columns = np.searchsorted(years, np.asarray(series_years, dtype=int))
+        table[row, columns] = np.asarray(series_values, dtype=float)
+    return years, table
 
 def get_country_temperatures(country):
     '''
@@ -20,15 +64,46 @@ def get_country_temperatures(country):
     Result is [ [year, value], [year, value], ...].
     '''
 
-    base_url = 'http://climatedataapi.worldbank.org/climateweb/rest/v1/country/cru/tas/year/{0}.csv'
-    actual_url = base_url.format(country)
-    response = requests.get(actual_url)
-    reader = cStringIO.StringIO(response.text)
-    wrapper = csv.reader(reader)
-    result = []
-    for record in wrapper:
-        if record[0] != 'year':
-            year = int(record[0])
-            value = float(record[1])
-            result.append([year, value])
-    return result
+    years, values = get_country_temperature_arrays(country)
+    return [[year, value] for (year, value) in zip(years, values)]
+
+def get_country_temperature_arrays(country):
+    '''
+    Get average surface temperature by country from the World Bank.
+    Result is (years, values): an array of ints and an array of floats.
+
+    The response is parsed a line at a time as it arrives, straight into
+    the two arrays, without copying it into a string first or making a
+    list for every row.
+    '''
+
+    actual_url = BASE_URL.format(country)
+    years = array.array('i')
+    values = array.array('d')
+    for record in csv.reader(cache.iter_lines(actual_url)):
+        if record and record[0] != 'year':
+            years.append(int(record[0]))
+            values.append(float(record[1]))
+    return years, values
+
+def get_many_country_temperatures(countries, arrays=False):
+    '''
+    Get average surface temperatures for several countries at once.
+    Result is { country : [ [year, value], [year, value], ...], ... },
+    or { country : (years, values), ... } if arrays is True.
+    '''
+
+    if arrays:
+        fetch = get_country_temperature_arrays
+    else:
+        fetch = get_country_temperatures
+
+    # Fetch each country once, however many times it is asked for
+    countries = list(set(countries))
+    pool = ThreadPool(max(1, min(MAX_THREADS, len(countries))))
+    try:
+        results = pool.map(fetch, countries)
+    finally:
+        pool.close()
+        pool.join()
+    return dict(zip(countries, results))
@@ -0,0 +1,151 @@
+'''
+Checks final.py against a small local server standing in for the World
+Bank, so it can run without the network:
+
+    python test_final.py
+
+Each test points final.BASE_URL at a fresh stub server and final.cache
+at an empty temporary directory, and puts them back afterwards.
+'''
+
+import shutil
+import tempfile
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+    class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+import final
+from webcache import ResponseCache
+
+# Made-up data served by the stub server, by country
+STUB_DATA = {
+    'CAN': [(1901, -7.5), (1902, -7.25), (1903, -6.5)],
+    'USA': [(1902, 8.5), (1903, 8.75), (1904, 9.0)],
+    'FRA': [(1901, 10.5), (1902, 11.0)],
+    'GBR': [(1901, 8.0), (1902, 8.25)],
+    # Much longer than any chunk a response is read in
+    'BIG': [(1000 + i, i * 0.25) for i in range(5000)],
+}
+
+# How long the stub server takes to answer each request, in seconds
+STUB_DELAY = 0.2
+
+def stub_body(country):
+    '''The CSV the stub server sends for country, with \\r\\n line endings.'''
+    rows = STUB_DATA.get(country, [])
+    return 'year,data\r\n' + ''.join('{0},{1}\r\n'.format(year, value) for (year, value) in rows)
+
+class StubHandler(BaseHTTPRequestHandler):
+    '''Answers /XYZ.csv with STUB_DATA['XYZ'] in the World Bank's CSV layout.'''
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+            server.active += 1
+            server.most_active = max(server.most_active, server.active)
+        try:
+            time.sleep(STUB_DELAY)
+            country = self.path.rsplit('/', 1)[-1].split('.')[0]
+            body = stub_body(country).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/csv')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+def with_stub_server(test):
+    '''
+    Run test(server) with final.BASE_URL pointing at a fresh stub server
+    and final.cache in an empty temporary directory.
+    '''
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.lock = threading.Lock()
+    server.requests = []
+    server.active = server.most_active = 0
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    old_url, old_cache = final.BASE_URL, final.cache
+    cache_dir = tempfile.mkdtemp()
+    final.BASE_URL = 'http://127.0.0.1:{0}/{{0}}.csv'.format(server.server_address[1])
+    final.cache = ResponseCache(directory=cache_dir, session=final.session)
+    try:
+        test(server)
+    finally:
+        final.BASE_URL, final.cache = old_url, old_cache
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(cache_dir)
+
+def check_concurrent_fetch(server):
+    countries = ['CAN', 'USA', 'FRA', 'GBR']
+    started = time.time()
+    result = final.get_many_country_temperatures(countries)
+    elapsed = time.time() - started
+    for country in countries:
+        assert result[country] == [list(row) for row in STUB_DATA[country]], country
+    assert server.most_active > 1, 'Countries should have been fetched at the same time'
+    assert elapsed < len(countries) * STUB_DELAY, 'Fetching took as long as one at a time'
+
+def check_duplicate_countries(server):
+    result = final.get_many_country_temperatures(['FRA'] * 4 + ['GBR'] * 2, arrays=True)
+    assert sorted(result) == ['FRA', 'GBR']
+    assert sorted(server.requests) == ['/FRA.csv', '/GBR.csv'], server.requests
+    years, values = result['FRA']
+    assert list(years) == [1901, 1902] and list(values) == [10.5, 11.0]
+
+def check_compare_countries_aligns_years(server):
+    # CAN has 1901-1903 and USA has 1902-1904, so only 1902 and 1903 compare
+    result = final.compare_countries('CAN', 'USA')
+    assert result == [[1902, -7.25 - 8.5], [1903, -6.5 - 8.75]], result
+    assert final.compare_countries('CAN', 'CAN') == [[1901, 0.0], [1902, 0.0], [1903, 0.0]]
+
+def check_crlf_across_chunks(server):
+    # Some of BIG's \r\n pairs are split between two chunks of the response
+    years, values = final.get_country_temperature_arrays('BIG')
+    assert list(years) == [year for (year, _) in STUB_DATA['BIG']]
+    assert list(values) == [value for (_, value) in STUB_DATA['BIG']]
+
+    # The copy iter_lines cached is exactly what the server sent
+    assert final.cache.get(final.BASE_URL.format('BIG')) == stub_body('BIG')
+    years, values = final.get_country_temperature_arrays('BIG')
+    assert len(years) == len(STUB_DATA['BIG'])
+    assert server.requests == ['/BIG.csv'], server.requests
+
+def test_concurrent_fetch():
+    with_stub_server(check_concurrent_fetch)
+
+def test_duplicate_countries():
+    with_stub_server(check_duplicate_countries)
+
+def test_compare_countries_aligns_years():
+    with_stub_server(check_compare_countries_aligns_years)
+
+def test_crlf_across_chunks():
+    with_stub_server(check_crlf_across_chunks)
+
+def run_tests():
+    test_concurrent_fetch()
+    test_duplicate_countries()
+    test_compare_countries_aligns_years()
+    test_crlf_across_chunks()
+    print('all tests passed')
+
+if __name__ == '__main__':
+    run_tests()
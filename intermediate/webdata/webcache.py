@@ -0,0 +1,241 @@
+'''
+A small on-disk cache for the text of HTTP GET responses.
+
+Each response is saved under a name made from its URL. A saved copy
+is used without asking the server while it is younger than the cache's
+time-to-live; after that the server is asked whether it has changed,
+using the ETag and Last-Modified headers it sent before, and only sends
+the data again if it has. When the cache grows past its size limit the
+least recently used responses are thrown away. In offline mode nothing
+is fetched at all, and anything not in the cache is an error.
+
+get returns a whole response as one string; iter_lines yields it one
+line at a time, saving the lines to the cache as they arrive from the
+server.
+'''
+
+import hashlib
+import io
+import json
+import os
+import tempfile
+import time
+
+import requests
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.webdata-cache')
+
+# Python 2 has no os.replace. os.rename also replaces an existing file
+# there, except on Windows.
+try:
+    _replace = os.replace
+except AttributeError:
+    _replace = os.rename
+
+class NotCachedError(Exception):
+    '''Raised in offline mode when a URL isn't in the cache.'''
+    pass
+
+class ResponseCache(object):
+    '''
+    Cache of response text keyed by URL.
+
+    directory : where to keep the cached responses
+    ttl : seconds a response is used without asking the server again
+    max_bytes : total size of cached responses to keep
+    offline : only answer from the cache, never from the network
+    session : requests.Session to fetch with
+    '''
+
+    def __init__(self, directory=CACHE_DIR, ttl=7 * 24 * 60 * 60,
+                 max_bytes=50 * 1024 * 1024, offline=False, session=None):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.session = session or requests.Session()
+
+    def _path(self, url, extension):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key + extension)
+
+    def _load_meta(self, url):
+        '''Return what was saved about url's response, or None if it isn't cached.'''
+        if not os.path.exists(self._path(url, '.txt')):
+            return None
+        try:
+            with io.open(self._path(url, '.json'), 'r', encoding='utf-8') as reader:
+                return json.load(reader)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _partial(self):
+        '''
+        Open a new temporary file in the cache directory to write a response
+        into. Each gets its own name, so threads fetching the same URL at
+        once don't write over each other. Returns (writer, name).
+        '''
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        handle, partial = tempfile.mkstemp(suffix='.part', dir=self.directory)
+        return io.open(handle, 'w', encoding='utf-8', newline=''), partial
+
+    def _write(self, path, text):
+        '''Write to a temporary file and rename it, so readers never see half a file.'''
+        writer, partial = self._partial()
+        with writer:
+            writer.write(text)
+        _replace(partial, path)
+
+    def _save(self, url, meta, text=None):
+        if text is not None:
+            self._write(self._path(url, '.txt'), text)
+        self._write(self._path(url, '.json'), u'{0}'.format(json.dumps(meta)))
+
+    def _new_meta(self, url, response):
+        return {'url': url,
+                'fetched': time.time(),
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified')}
+
+    def _touch(self, url):
+        '''Mark url as just used, for least-recently-used eviction.'''
+        try:
+            os.utime(self._path(url, '.txt'), None)
+        except OSError:
+            pass
+
+    def evict(self):
+        '''Remove least recently used responses until the cache fits in max_bytes.'''
+        if not os.path.isdir(self.directory):
+            return
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.txt'):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            for victim in (path, path[:-len('.txt')] + '.json'):
+                try:
+                    os.remove(victim)
+                except OSError:
+                    pass
+            total -= size
+
+    def _request(self, url):
+        '''
+        Decide whether the cached copy of url can be used. Returns None if it
+        can, or the server's (streamed) response if it can't.
+        '''
+
+        meta = self._load_meta(url)
+        if meta is not None and (self.offline or time.time() - meta['fetched'] < self.ttl):
+            self._touch(url)
+            return None
+        return self._fetch(url, meta)
+
+    def _fetch(self, url, meta=None):
+        '''
+        Ask the server for url, only sending the data if it has changed since
+        the response described by meta. Returns None if it hasn't, or the
+        server's (streamed) response.
+        '''
+
+        if self.offline:
+            raise NotCachedError('{0} is not in the cache'.format(url))
+
+        # Ask the server to send the data only if it has changed
+        headers = {}
+        if meta is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        response = self.session.get(url, headers=headers, stream=True)
+        if response.status_code == 304 and meta is not None:
+            response.close()
+            meta['fetched'] = time.time()
+            self._save(url, meta)
+            self._touch(url)
+            return None
+        return response
+
+    def get(self, url):
+        '''Return the text of url, from the cache if possible.'''
+
+        response = self._request(url)
+        if response is None:
+            try:
+                with io.open(self._path(url, '.txt'), 'r', encoding='utf-8', newline='') as reader:
+                    return reader.read()
+            except (IOError, OSError):
+                # Another thread evicted it since _request looked
+                response = self._fetch(url)
+
+        # Only keep successful responses; errors are passed through as they are
+        if response.status_code == 200:
+            self._save(url, self._new_meta(url, response), response.text)
+            self.evict()
+        return response.text
+
+    def iter_lines(self, url):
+        '''
+        Yield the lines of url without their line endings, from the cache if
+        possible. Lines fetched from the server are written to the cache as
+        they go by, and the copy is only kept if all of them were read.
+        '''
+
+        response = self._request(url)
+        if response is None:
+            try:
+                reader = io.open(self._path(url, '.txt'), 'r', encoding='utf-8', newline='')
+            except (IOError, OSError):
+                # Another thread evicted it since _request looked
+                response = self._fetch(url)
+            else:
+                with reader:
+                    for line in reader:
+                        yield line.rstrip(u'\r\n')
+                return
+
+        # Decode the body as it is read, rather than with requests'
+        # iter_lines, which splits a \r\n that falls across two chunks into
+        # two lines. newline='' keeps each line's ending as the server sent
+        # it, so the cached copy is the same text get() would have saved.
+        # Without auto_close, urllib3 would close the stream as soon as the
+        # last byte is read, and the decoder can't tell that from an error.
+        response.raw.decode_content = True
+        response.raw.auto_close = False
+        reader = io.TextIOWrapper(response.raw, encoding=response.encoding or 'utf-8', newline='')
+
+        if response.status_code != 200:
+            with reader:
+                for line in reader:
+                    yield line.rstrip(u'\r\n')
+            return
+
+        writer, partial = self._partial()
+        complete = False
+        try:
+            with writer, reader:
+                for line in reader:
+                    writer.write(line)
+                    yield line.rstrip(u'\r\n')
+            complete = True
+        finally:
+            response.close()
+            if not complete:
+                os.remove(partial)
+
+        _replace(partial, self._path(url, '.txt'))
+        self._save(url, self._new_meta(url, response))
+        self.evict()